@@ -1,16 +1,61 @@
+import numbers
+import numpy as np
 from pandas import DataFrame, Series
 from gbutils import *
 
 
+class Positions(object):
+    """Read-only view of positions, named by symbol in index and by symbol id in ids."""
+
+    __slots__ = ('index', 'qty', 'price', 'ids')
+
+
+    def __init__(self, index, qty, price, ids):
+        for array in (index, qty, price, ids):
+            array.flags.writeable = False
+        self.index = index
+        self.qty = qty
+        self.price = price
+        self.ids = ids
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def to_frame(self):
+        '''Returns a DataFrame copy of the positions.'''
+        return DataFrame({'qty': self.qty, 'price': self.price}, index=self.index, columns=['qty', 'price'])
+
+
+    def __repr__(self):
+        return repr(self.to_frame())
+
+
 class AccountManager(object):
-    """Used to manage a portfolio of stock and cash."""
+    """Used to manage a portfolio of stock and cash.
+
+    Positions are kept in arrays of quantity and average price indexed by the
+    symbol ids of the quote manager, so valuations are dot products against a
+    vector of quotes.  A stock may be passed by symbol or by symbol id.  Long and short positions are listed in the order each
+    stock was first added to the account.
+
+    Valuations are marked to market once per date and then kept up to date by
+    each trade, so repeated valuations on a rebalance date cost O(1).
+    """
 
 
     def __init__(self, start_cap, margin_percent, quote_manager):
         self._cash = start_cap
         self._margin_percent = margin_percent
         self._quote_manager = quote_manager
-        self._stock = DataFrame(columns=['qty', 'price'])
+        self._symbols = np.array(quote_manager.get_symbols(), dtype=object)
+        self._symbol_ids = dict((symbol, i) for i, symbol in enumerate(self._symbols))
+        self._qty = np.zeros(len(self._symbols))
+        self._price = np.zeros(len(self._symbols))
+        self._added = np.full(len(self._symbols), -1, dtype=np.intp)
+        self._added_count = 0
+        self._clear_marks()
         return super(AccountManager, self).__init__()
 
 
@@ -36,74 +81,139 @@ class AccountManager(object):
         return self.get_account_value(date) * percent
 
 
+    def _get_symbol_id(self, symbol):
+        '''Returns the symbol id of a stock, which may already be an id.'''
+        if isinstance(symbol, numbers.Integral):
+            return symbol
+        return self._symbol_ids[symbol]
+
+
+    def get_qty(self, symbol):
+        '''Returns the quantity held of a stock, negative when short.'''
+        return self._qty[self._get_symbol_id(symbol)]
+
+
     def get_position_value(self, symbol, date):
         '''Returns the total value of a specified stock.'''
-        if self._stock.qty[symbol] > 0:
-            return self._quote_manager.get_quote(symbol, date) * abs(self._stock.qty[symbol])
+        i = self._get_symbol_id(symbol)
+        self._mark_to_market(date)
+        long_value, short_value = self._get_position_marks(i)
+        if self._qty[i] > 0:
+            return long_value
         else:
-            shorts = self._stock[self._stock.qty < 0].copy()
-            shorts['original_value'   ] = shorts.price * shorts.qty
-            shorts['current_price'    ] = [self._quote_manager.get_quote(stock, date) for stock in shorts.index]
-            shorts['current_price_qty'] = shorts.current_price * shorts.qty
-            shorts['returns'          ] = ((shorts.current_price_qty / shorts.original_value) - 1) * -1
-            shorts['value'            ] = (1 + shorts.returns) * shorts.original_value
-            return -shorts.value[symbol]
+            return -short_value
+
+
+    def _clear_marks(self):
+        '''Forgets the valuation of the marked date.'''
+        self._mark_date = None
+        self._mark_prices = {}
+        self._mark_long = 0.
+        self._mark_short = 0.
+
+
+    def _mark_to_market(self, date):
+        '''Prices every position held on date unless the account is already marked on date.'''
+        if date == self._mark_date:
+            return
+        ids = np.flatnonzero(self._qty != 0)
+        current_prices = self._quote_manager.get_quotes(ids, date)
+        self._mark_date = date
+        self._mark_prices = dict(zip(ids, current_prices))
+        long = self._qty[ids] > 0
+        self._mark_long = np.dot(current_prices[long], self._qty[ids][long])
+        self._mark_short = 2 * np.dot(self._price[ids][~long], self._qty[ids][~long]) - \
+                           np.dot(current_prices[~long], self._qty[ids][~long])
+
+
+    def _get_position_marks(self, i):
+        '''Returns the long and short value of one position on the marked date.'''
+        if self._mark_date is None:
+            return 0., 0.
+        current_price = self._mark_prices.get(i)
+        if current_price is None:
+            current_price = self._quote_manager.get_quotes(np.array([i]), self._mark_date)[0]
+            self._mark_prices[i] = current_price
+        if self._qty[i] > 0:
+            return current_price * self._qty[i], 0.
+        elif self._qty[i] < 0:
+            # A short position gains what the price has fallen from the average short price
+            return 0., (2 * self._price[i] - current_price) * self._qty[i]
+        return 0., 0.
+
+
+    def _update_marks(self, i, old_marks):
+        '''Adjusts the marked valuation by the change in value of one traded position.'''
+        if self._mark_date is None:
+            return
+        new_marks = self._get_position_marks(i)
+        if np.isnan(old_marks).any() or np.isnan(new_marks).any():
+            # Missing prices can't be backed out of the totals, so price everything again
+            self._clear_marks()
+            return
+        self._mark_long += new_marks[0] - old_marks[0]
+        self._mark_short += new_marks[1] - old_marks[1]
+
+
+    def _get_positions(self, ids):
+        ids = ids[np.argsort(self._added[ids], kind='mergesort')]
+        return Positions(self._symbols[ids], self._qty[ids], self._price[ids], ids)
 
 
     def get_positions(self):
-        '''Returns a DataFrame copy of all positions held.'''
-        return self._stock.copy()
+        '''Returns a read-only view of the positions of every symbol ordered by symbol id.'''
+        return Positions(self._symbols.view(), self._qty.view(), self._price.view(),
+                         np.arange(len(self._symbols)))
 
 
     def get_short_positions(self):
-        '''Returns a DataFrame copy of short positions held.'''
-        return self._stock[self._stock.qty < 0].copy()
+        '''Returns a read-only view of short positions held.'''
+        return self._get_positions(np.flatnonzero(self._qty < 0))
 
 
     def get_short_value(self, date):
         '''Returns a sum of all short positions.'''
-        shorts = self._stock[self._stock.qty < 0].copy()
-        shorts['original_value'   ] = shorts.price * shorts.qty
-        shorts['current_price'    ] = [self._quote_manager.get_quote(stock, date) for stock in shorts.index]
-        shorts['current_price_qty'] = shorts.current_price * shorts.qty
-        shorts['returns'          ] = ((shorts.current_price_qty / shorts.original_value) - 1) * -1
-        shorts['value'            ] = (1 + shorts.returns) * shorts.original_value
+        self._mark_to_market(date)
         # TODO: should this value be returned times -1 so that it is positive?
-        return shorts.value.sum()
+        return self._mark_short
 
 
     def get_long_positions(self):
-        '''Returns a DataFrame copy of long positions held.'''
-        return self._stock[self._stock.qty > 0].copy()
+        '''Returns a read-only view of long positions held.'''
+        return self._get_positions(np.flatnonzero(self._qty > 0))
 
 
     def get_long_value(self, date):
         '''Returns a sum of all long positions.'''
-        value = 0
-        for stock in self._stock[self._stock.qty > 0].index:
-            value += self._quote_manager.get_quote(stock, date) * self._stock.qty[stock]
-        return value    
+        self._mark_to_market(date)
+        return self._mark_long
 
 
     def add_stock(self, symbol, qty, price):
-        if symbol in self._stock.index:
-            qty_owned = self._stock.loc[symbol].qty
-            price_owned = self._stock.loc[symbol].price
-            new_price = (qty_owned * price_owned + qty * price) / (qty_owned + qty)
+        i = self._get_symbol_id(symbol)
+        if self._added[i] < 0:
+            self._added[i] = self._added_count
+            self._added_count += 1
+        old_marks = self._get_position_marks(i)
+        qty_owned = self._qty[i]
+        if qty_owned != 0:
+            new_price = (qty_owned * self._price[i] + qty * price) / (qty_owned + qty)
         else:
-            qty_owned = 0
             new_price = price
-        self._stock.loc[symbol] = [qty_owned + qty, new_price]
+        self._qty[i] = qty_owned + qty
+        self._price[i] = new_price
+        self._update_marks(i, old_marks)
 
 
     def remove_stock(self, symbol, qty, price):
         # Assert we own the stock to be removed
-        assert symbol in self._stock.index, \
+        i = symbol if isinstance(symbol, numbers.Integral) else self._symbol_ids.get(symbol)
+        assert i is not None and self._qty[i] != 0, \
             'ERROR in AccountManager.remove_stock() >>' + \
-            'Symbol: %s is not in account stock: %s' % (symbol, self._stock.index)
+            'Symbol: %s is not in account stock: %s' % (symbol, self.get_positions().index[self._qty != 0])
         
         # Get quantity of stock owned
-        qty_owned = self._stock.loc[symbol].qty
+        qty_owned = self._qty[i]
         
         # Assert we are only trying to cover short positions or sell long positions
         assert qty_owned * qty < 0, \
@@ -117,11 +227,67 @@ class AccountManager(object):
             'qty_owned (%s) is less than qty being removed: %s' % (qty_owned, qty)
 
         # Adjust stock quantity by passed quantity
-        self._stock.loc[symbol].qty = qty_owned + qty
+        old_marks = self._get_position_marks(i)
+        self._qty[i] = qty_owned + qty
 
         # If the quantity owned is equal to that being removed, set price == 0
         if abs(qty_owned) == abs(qty):
-            self._stock.loc[symbol].price = 0.
+            self._price[i] = 0.
+        self._update_marks(i, old_marks)
+
+
+    def apply_trades(self, symbols, qty, prices):
+        '''Adds signed quantities of stock traded at prices in one batch.  Each symbol may
+        appear once and its trade must either open or add to a position, or reduce it.'''
+        ids = self._quote_manager.get_symbol_ids(symbols)
+        qty = np.asarray(qty, dtype=float)
+        prices = np.asarray(prices, dtype=float)
+        assert len(set(ids)) == len(ids), \
+            'ERROR in AccountManager.apply_trades() >> symbols must be unique: %s' % list(symbols)
+
+        # Reducing trades keep the average price, adding trades average in the new price
+        qty_owned = self._qty[ids]
+        reducing = qty_owned * qty < 0
+        assert (abs(qty[reducing]) <= abs(qty_owned[reducing])).all(), \
+            'ERROR in AccountManager.apply_trades() >> can not remove more stock than is owned'
+        new_qty = qty_owned + qty
+        with np.errstate(invalid='ignore', divide='ignore'):
+            added_price = np.where(qty_owned == 0, prices, (qty_owned * self._price[ids] + qty * prices) / new_qty)
+        new_price = np.where(reducing, np.where(new_qty == 0, 0., self._price[ids]), added_price)
+
+        # Remember the order stocks are first added in
+        new_ids = ids[(self._added[ids] < 0) & (qty != 0)]
+        self._added[new_ids] = self._added_count + np.arange(len(new_ids))
+        self._added_count += len(new_ids)
+
+        self._qty[ids] = new_qty
+        self._price[ids] = new_price
+        self._clear_marks()
+
+
+    def get_state(self):
+        '''Returns the cash and positions of the account as a dict of arrays.'''
+        return {'cash'          : np.float64(self._cash),
+                'margin_percent': np.float64(self._margin_percent),
+                'symbols'       : np.array(self._symbols, dtype=str),
+                'qty'           : self._qty.copy(),
+                'price'         : self._price.copy(),
+                'added'         : self._added.copy(),
+                'added_count'   : np.int64(self._added_count)
+                }
+
+
+    def set_state(self, state):
+        '''Restores the cash and positions saved by get_state().'''
+        assert list(state['symbols']) == list(self._symbols), \
+            'ERROR in AccountManager.set_state() >> the state was saved with different quote symbols'
+        self._cash = float(state['cash'])
+        self._margin_percent = float(state['margin_percent'])
+        self._qty = np.array(state['qty'], dtype=float)
+        self._price = np.array(state['price'], dtype=float)
+        self._added = np.array(state['added'], dtype=np.intp)
+        self._added_count = int(state['added_count'])
+        self._clear_marks()
 
 
     def deposit_cash(self, amount):
@@ -141,7 +307,7 @@ class AccountManager(object):
 if __name__ == '__main__':
     from quote_manager import QuoteManager
     qm = QuoteManager('data/daily_gold.db')
-    am = AccountManager(100000., qm)
+    am = AccountManager(100000., 100., qm)
 
     am.add_stock('EDV', -20, 100.)
     print(am.get_account_value('2016_10_17'))
@@ -149,10 +315,10 @@ if __name__ == '__main__':
     am.add_stock('ABX', 20, 100.)
     print(am.get_account_value('2016_10_17'))
 
-    am.remove_stock('ABX', -10)
+    am.remove_stock('ABX', -10, 100.)
     print(am.get_account_value('2016_10_17'))
 
-    print(am._stock.loc['ABX'])
+    print(am.get_qty('ABX'))
 
     am.add_stock('ABX', 10, 50.)
     print(am.get_account_value('2016_10_17'))
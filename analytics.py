@@ -0,0 +1,130 @@
+import numpy as np
+from rebalance_calendar import to_datetime64
+
+
+# Every function works along the last axis, so values may be one equity curve of shape
+#   (dates,) or a stack of runs of shape (runs, dates) sharing the same dates
+
+
+# Estimate how many periods of the date index fall in a year
+def get_periods_per_year(dates):
+    days = to_datetime64(dates).astype('datetime64[D]').astype(np.int64)
+    return (len(days) - 1) * 365.25 / (days[-1] - days[0])
+
+
+# Get the return of each period of an equity curve
+def get_returns(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values[..., 1:] / values[..., :-1] - 1
+
+
+# Get the compound annual growth rate of an equity curve, NaN for fewer than two values
+#   or a start value of zero
+def get_cagr(values, periods_per_year):
+    values = np.asarray(values, dtype=np.float64)
+    if values.shape[-1] < 2:
+        return np.full(values.shape[:-1], np.nan)[()]
+    years = (values.shape[-1] - 1) / float(periods_per_year)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cagr = (values[..., -1] / values[..., 0]) ** (1. / years) - 1
+    return np.where(values[..., 0] != 0, cagr, np.nan)[()]
+
+
+# Get the annualized standard deviation of returns
+def get_volatility(returns, periods_per_year):
+    return np.std(returns, axis=-1, ddof=1) * np.sqrt(periods_per_year)
+
+
+# Get the annualized mean excess return over its standard deviation
+def get_sharpe(returns, periods_per_year, risk_free=0.):
+    excess = np.asarray(returns) - risk_free / float(periods_per_year)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.mean(excess, axis=-1) / np.std(excess, axis=-1, ddof=1) * np.sqrt(periods_per_year)
+
+
+# Get the annualized mean excess return over its downside deviation
+def get_sortino(returns, periods_per_year, risk_free=0.):
+    excess = np.asarray(returns) - risk_free / float(periods_per_year)
+    downside = np.sqrt(np.mean(np.minimum(excess, 0.) ** 2, axis=-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.mean(excess, axis=-1) / downside * np.sqrt(periods_per_year)
+
+
+# Get the drawdown from the running peak at every date of an equity curve
+def get_drawdowns(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values / np.maximum.accumulate(values, axis=-1) - 1
+
+
+# Get the largest fall from a peak of an equity curve, as a negative fraction
+def get_max_drawdown(values):
+    return np.min(get_drawdowns(values), axis=-1)
+
+
+# Get the mean of every window of consecutive values, NaN until a window is full
+def get_rolling_mean(values, window):
+    values = np.asarray(values, dtype=np.float64)
+    sums = np.cumsum(values, axis=-1)
+    rolling = np.full(values.shape, np.nan)
+    rolling[..., window-1:] = sums[..., window-1:]
+    rolling[..., window:] -= sums[..., :-window]
+    return rolling / window
+
+
+# Get the sample standard deviation of every window of consecutive values, NaN until a window is full
+def get_rolling_std(values, window):
+    values = np.asarray(values, dtype=np.float64)
+    mean = get_rolling_mean(values, window)
+    mean_square = get_rolling_mean(values ** 2, window)
+    variance = np.maximum(mean_square - mean ** 2, 0.) * window / (window - 1.)
+    return np.sqrt(variance)
+
+
+# Get the value traded on each of the sorted dates from the dates, shares and prices of orders
+def get_traded_values(dates, order_dates, shares, prices):
+    rows = np.searchsorted(np.asarray(dates), np.asarray(order_dates))
+    return np.bincount(rows, weights=np.abs(np.asarray(shares) * np.asarray(prices)), minlength=len(dates))
+
+
+# Get the value traded over the average value of the portfolio
+def get_turnover(traded_values, values):
+    return np.sum(traded_values, axis=-1) / np.mean(values, axis=-1)
+
+
+# Get the annualized alpha and the beta of returns against benchmark returns, skipping
+#   periods where either return is missing
+def get_alpha_beta(returns, benchmark_returns, periods_per_year):
+    returns, benchmark_returns = np.broadcast_arrays(np.asarray(returns, dtype=np.float64),
+                                                     np.asarray(benchmark_returns, dtype=np.float64))
+    valid = ~np.isnan(returns) & ~np.isnan(benchmark_returns)
+    count = valid.sum(axis=-1)
+    returns = np.where(valid, returns, 0.)
+    benchmark_returns = np.where(valid, benchmark_returns, 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = returns.sum(axis=-1) / count
+        benchmark_mean = benchmark_returns.sum(axis=-1) / count
+        covariance = (returns * benchmark_returns).sum(axis=-1) / count - mean * benchmark_mean
+        variance = (benchmark_returns ** 2).sum(axis=-1) / count - benchmark_mean ** 2
+        beta = covariance / variance
+    alpha = (mean - beta * benchmark_mean) * periods_per_year
+    return alpha, beta
+
+
+def summarize(values, dates, benchmark=None, traded_values=None, risk_free=0.):
+    '''Returns a dict of the performance statistics of one equity curve, or of each
+    row of a (runs x dates) stack of them.  benchmark is the value of a benchmark on
+    the same dates and traded_values the value traded on each date.'''
+    periods_per_year = get_periods_per_year(dates)
+    returns = get_returns(values)
+    stats = {'total_return' : np.asarray(values)[..., -1] / np.asarray(values)[..., 0] - 1,
+             'cagr'         : get_cagr(values, periods_per_year),
+             'volatility'   : get_volatility(returns, periods_per_year),
+             'sharpe'       : get_sharpe(returns, periods_per_year, risk_free),
+             'sortino'      : get_sortino(returns, periods_per_year, risk_free),
+             'max_drawdown' : get_max_drawdown(values)
+             }
+    if benchmark is not None:
+        stats['alpha'], stats['beta'] = get_alpha_beta(returns, get_returns(benchmark), periods_per_year)
+    if traded_values is not None:
+        stats['turnover'] = get_turnover(traded_values, values)
+    return stats
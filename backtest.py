@@ -0,0 +1,414 @@
+import os
+import numpy as np
+import pandas as pd
+from gbutils import *
+from rebalance_calendar import get_rebalance_positions, to_date_strings, to_days
+from account_manager import AccountManager
+from order_manager import OrderManager
+from history_recorder import HistoryRecorder
+from checkpoint import CheckpointStore, chain_hashes, get_hash, get_source_hash, join_state, split_state
+
+
+# Parameters of a backtest run
+DEFAULT_CONFIG = {
+    'rebal_frequency'   : 'month',          # Rebalance at the close of each 'day', 'week', 'month', 'quarter', 'year' or on a list of dates
+    'rebal_period'      : 1,                # Number of rebal_frequency periods between rebalance
+    'start_balance'     : 100000.,          # Starting cash balance in portfolio
+    'margin_percent'    : 100.,             # The margin account size as a percent of account value
+    'start_day'         : '2008_01_02',     # Day of initial stock purchases 'YYYY_MM_DD'
+    'commission'        : .005,             # Cost in dollars per share traded
+    'commission_min'    : 1.,               # Minimum cost in dollars per stock traded
+    'commission_max'    : .005,             # Maximum cost in percent of trade value
+    'slippage'          : .01,              # Average slippage in price due to market volatility
+    'long_count'        : 10,               # Number of undervalued stock held long
+    'short_count'       : 10,               # Number of top GDX stock held short
+    'position_percent'  : .05,              # Target value of each position as a percent of account value
+    'batch_rebalance'   : False             # Trade to target weights in one batch instead of the sequential rules
+    }
+
+
+# Modules whose code decides the results of a run, hashed into the key of its checkpoints
+ENGINE_SOURCES = ['backtest.py', 'account_manager.py', 'order_manager.py', 'history_recorder.py',
+                  'gbutils.py', 'rebalance_calendar.py', 'checkpoint.py']
+
+
+def load_signals(signals_path, gdx_csv_path):
+    '''Returns the signals DataFrame indexed by int32 day numbers and the GDX component
+    symbols that have signals.'''
+    signals = pd.read_csv(signals_path, index_col=0)
+    signals.index = to_days(signals.index)
+    gdx_symbols = pd.read_csv(gdx_csv_path).symbol
+    gdx_symbols = gdx_symbols[gdx_symbols.isin(signals.columns)]
+    return signals, gdx_symbols
+
+
+class Backtest(object):
+    """Runs the rebalancing strategy on quotes and signals loaded once.
+
+    A Backtest only holds references to the quote manager and signals, so one
+    loaded QuoteManager and signals DataFrame can serve any number of runs.
+    Every call to run() starts from a fresh account.
+
+    Dates are handled as the int32 day numbers of rebalance_calendar.to_days() and
+    only turned into 'YYYY_MM_DD' strings in the log and the returned DataFrames.
+    """
+
+    # Changed whenever the state saved in checkpoints changes, so older checkpoints are not resumed
+    CHECKPOINT_VERSION = 2
+
+
+    def __init__(self, config, quote_manager, signals, gdx_symbols):
+        '''Any keys missing from config are taken from DEFAULT_CONFIG.'''
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.quote_manager = quote_manager
+        self.signals = signals
+        self.gdx_symbols = gdx_symbols
+        self.account = None
+        self.order_manager = None
+        self.positions = None
+        self.holdings = None
+
+        # Get period close rebalance days from start_day on, determined by rebal_frequency and rebal_period
+        self.signal_days = to_days(signals.index)
+        self.rebalance_positions = get_rebalance_positions(self.signal_days,
+                                                           frequency   = self.config['rebal_frequency'],
+                                                           period      = self.config['rebal_period'],
+                                                           start       = self.config['start_day']
+                                                           )
+        self.rebalance_days = self.signal_days[self.rebalance_positions]
+        return super(Backtest, self).__init__()
+
+
+    def get_checkpoint_store(self, checkpoint_path):
+        '''Returns a CheckpointStore for this run keyed by a hash of the config and
+        symbols and the ENGINE_SOURCES code, and by hashes of the Adj_Close quotes and
+        signals up to each rebalance day.'''
+        quote_manager = self.quote_manager
+        assert not quote_manager.lazy, \
+            "ERROR in Backtest.get_checkpoint_store() >> a lazy QuoteManager can't hash its quotes"
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        source_hash = get_source_hash([os.path.join(source_dir, name) for name in ENGINE_SOURCES])
+        config_hash = get_hash(self.CHECKPOINT_VERSION, source_hash, sorted(self.config.items()),
+                               list(self.gdx_symbols), list(self.signals.columns), quote_manager.get_symbols())
+
+        # Each rebalance day adds the quote and signal rows since the day before it to the chain
+        symbols = quote_manager.get_symbol_ids(quote_manager.get_symbols())
+        quote_days = quote_manager.get_days()
+        quote_ends = np.searchsorted(quote_days, self.rebalance_days, side='right')
+        signal_ends = np.asarray(self.rebalance_positions) + 1
+        blocks = []
+        for i, date in enumerate(self.rebalance_days):
+            quote_rows = slice(quote_ends[i-1] if i else 0, quote_ends[i])
+            signal_rows = slice(signal_ends[i-1] if i else 0, signal_ends[i])
+            blocks.append([date,
+                           quote_manager.get_quote_matrix(symbols, quote_days[quote_rows]),
+                           self.signals.values[signal_rows].astype(np.float64)])
+
+        # The rebalance on the last signal day may end a partial period, which is no longer
+        #   a rebalance day once later signals arrive, while every other one closes its period
+        closed = np.asarray(self.rebalance_positions) < len(self.signal_days) - 1
+        return CheckpointStore(checkpoint_path, config_hash, to_date_strings(self.rebalance_days),
+                               chain_hashes(blocks), closed)
+
+
+    def run(self, verbose=True, writer=None, keep=True, checkpoint_path=None):
+        '''Returns the history DataFrame with one row per metric and one column per
+        rebalance day, and a DataFrame of every order placed.  The positions held on
+        each rebalance day before trading are left in self.positions.
+
+        Pass a HistoryWriter to stream every row to disk as it is recorded, and
+        keep=False to leave the positions and orders only on disk.
+
+        With a checkpoint_path the state is saved there after every rebalance, and
+        the run resumes after the latest checkpoint whose config and data still match.'''
+        config = self.config
+        quote_manager = self.quote_manager
+        signals = self.signals
+        gdx_symbols = self.gdx_symbols
+        long_count = config['long_count']
+        short_count = config['short_count']
+
+        def log(message):
+            if verbose:
+                print(message)
+
+        # Create AccountManager object
+        self.account = my_account = AccountManager(config['start_balance'], config['margin_percent'], quote_manager)
+
+        # Create OrderManager object
+        self.order_manager = order_manager = OrderManager(quote_manager,
+                                                          my_account,
+                                                          slippage       = config['slippage'],
+                                                          commission_min = config['commission_min'],
+                                                          commission     = config['commission'],
+                                                          commission_max = config['commission_max']
+                                                          )
+
+        # Rank the undervalued stock of every rebalance day up front
+        ranking = SignalRanking(signals.iloc[self.rebalance_positions], quote_manager, count=long_count)
+        rebalance_days = self.rebalance_days.tolist()
+        rebalance_dates = to_date_strings(self.rebalance_days)
+
+        # Stock is handled by its symbol id and only named in the log and the recorded rows
+        symbols = np.array(quote_manager.get_symbols(), dtype=object)
+        gdx_ids = quote_manager.get_symbol_ids(gdx_symbols.values)
+
+        # Record account metrics, positions and every order placed to be saved in output folder
+        recorder = HistoryRecorder(self.rebalance_days, writer=writer, keep=keep)
+
+        def record_order(stock, order_results):
+            recorder.record_trade(date, symbols[stock], order_results)
+
+        # Resume from the latest valid checkpoint
+        old_date        = None
+        old_long_value  = None
+        start = 0
+        if checkpoint_path is not None:
+            checkpoints = self.get_checkpoint_store(checkpoint_path)
+            cursor, state = checkpoints.load_latest()
+            if state is not None:
+                state = split_state(state, ['account', 'orders', 'recorder', 'run'])
+                my_account.set_state(state['account'])
+                order_manager.set_state(state['orders'])
+                recorder.set_state(state['recorder'])
+                old_long_value = float(state['run']['old_long_value'])
+                old_short_value = float(state['run']['old_short_value'])
+                old_date = rebalance_days[cursor]
+                start = cursor + 1
+                log("Resuming after the checkpoint of %s" % rebalance_dates[cursor])
+
+        # Perform rebalancing every rebal_period of months
+        for cursor in range(start, len(rebalance_days)):
+            date = rebalance_days[cursor]
+
+            log(" "*60 + rebalance_dates[cursor])
+
+            # Get total account value
+            pre_account_value = my_account.get_account_value(date)
+            cash = my_account.get_cash_value()
+
+            # Get undervalued_stock for current date
+            new_undervalued = ranking.get_undervalued_ids(date)
+            if len(new_undervalued) == 0:
+                log("NO VALID UNDERVALUED STOCK FOUND FOR DATE: %s" % rebalance_dates[cursor])
+
+            # Get top gdx stock excluding undervalued_stock for current date
+            new_top_gdx = gdx_ids[select_top_gdx(gdx_ids, quote_manager, date, new_undervalued, count=short_count)]
+            if len(new_top_gdx) == 0:
+                log("NO VALID GDX COMPONENT STOCK FOUND FOR DATE: %s" % rebalance_dates[cursor])
+
+            # Get positions for calculating unrealized returns
+            long_positions = my_account.get_long_positions()
+            long_value = my_account.get_long_value(date)
+
+            short_positions = my_account.get_short_positions()
+            short_value = my_account.get_short_value(date)
+
+            # Flag the undervalued stock by symbol id, so membership is an array lookup
+            is_undervalued = np.zeros(len(symbols), dtype=bool)
+            is_undervalued[new_undervalued] = True
+
+            # Get unrealized returns
+            if old_long_value != None:
+
+                # Add margin returns
+                margin_long_gains = long_value - old_long_value
+                margin_short_gains = abs(short_value) - abs(old_short_value)
+                my_account.deposit_cash(margin_long_gains + margin_short_gains)
+
+                # Adjust long and short values for margin returns
+                long_value += margin_long_gains
+                short_value -= margin_short_gains
+
+                # Calculate long and short returns
+                long_return = get_return(long_value, old_long_value) * .5
+                short_return = get_return(short_value, old_short_value) * .5
+                total_return = long_return + short_return
+            else:
+                long_return = 0
+                short_return = 0
+                total_return = 0
+
+            # Get account value adjusted for margin returns
+            account_value = my_account.get_account_value(date)
+
+            recorder.record_metrics(date, [account_value, cash, long_value, short_value,
+                                           total_return, long_return, short_return])
+            for side, positions in (('long', long_positions), ('short', short_positions)):
+                recorder.record_positions(date, side, positions.index, positions.qty,
+                                          [my_account.get_position_value(stock, date) for stock in positions.ids])
+
+            if config['batch_rebalance']:
+                # Trade every position to its target weight in one batch
+                target_weights = [(stock, config['position_percent']) for stock in new_undervalued] + \
+                                 [(stock, -config['position_percent']) for stock in new_top_gdx]
+                placed = order_manager.rebalance_to(target_weights, date)
+                recorder.record_trades(date, *[placed[name] for name in order_manager.ORDER_COLUMNS])
+                for stock, order_type, shares in zip(placed['symbol'], placed['type'], placed['shares']):
+                    log('Placed %s order for %s shares of %s' % (order_type, shares, stock))
+            else:
+                # Sell stock no longer on undervalued list
+                long_positions = my_account.get_long_positions()
+                for stock in long_positions.ids:
+                    if not is_undervalued[stock]:
+                        record_order(stock, order_manager.sell_all(stock, date))
+                        log('Sold %s because it is no longer on undervalued list' % symbols[stock])
+
+                # Sell portion of stock on undervalued list that exceeds the target percent of account value
+                long_positions = my_account.get_long_positions()
+                for stock in long_positions.ids:
+                    account_value = my_account.get_account_value(date)
+                    target_value = config['position_percent'] * account_value
+                    current_price = quote_manager.get_quote(stock, date)
+                    value = abs(my_account.get_position_value(stock, date))
+                    diff_value = value - target_value
+                    if diff_value > current_price:
+                        record_order(stock, order_manager.sell(diff_value + current_price, stock, date))
+                        log('Sold some of %s because its value exceeds the target percent of portfolio' % symbols[stock])
+                        new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
+                        log('New % of portfolio for {}: {:.3}'.format(symbols[stock], new_comp))
+
+                # Cover stock that now appears on undervalued list and that no longer is on gdx list
+                short_positions = my_account.get_short_positions()
+                for stock in short_positions.ids:
+                    if is_undervalued[stock]:
+                        record_order(stock, order_manager.cover_all(stock, date))
+                        log('Covered %s because it is now on undervalued list' % symbols[stock])
+                    else:
+                        #TODO: The gdx list was tested with 'in' on its Series, which searches the index and
+                        #   not the symbols, so every short off the undervalued list is covered, find out if intended
+                        record_order(stock, order_manager.cover_all(stock, date))
+                        log('Covered %s because it is no longer on gdx list' % symbols[stock])
+
+                #TODO: This rebalance action is not working, find out why
+                # Cover portion of stock on gdx list that exceeds the target percent of account value
+                short_positions = my_account.get_short_positions()
+                for stock in short_positions.ids:
+                    account_value = my_account.get_account_value(date)
+                    target_value = config['position_percent'] * account_value
+                    current_price = quote_manager.get_quote(stock, date)
+                    value = abs(my_account.get_position_value(stock, date))
+                    diff_value = value - target_value
+                    if diff_value > current_price:
+                        record_order(stock, order_manager.cover(diff_value + current_price, stock, date))
+                        log('Covered some of %s because its value exceeds the target percent of portfolio' % symbols[stock])
+                        new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
+                        log('New % of portfolio for {}: {:.3}'.format(symbols[stock], new_comp))
+
+                # Buy stock new to undervalued list
+                for stock in new_undervalued:
+                    if my_account.get_qty(stock) <= 0:
+                        account_value = my_account.get_account_value(date)
+                        target_value = config['position_percent'] * account_value
+                        record_order(stock, order_manager.buy(target_value, stock, date))
+                        log('Bought %s because it is now on the undervalued list' % symbols[stock])
+
+                # Buy more of stock on undervalue list that is below the target percent of account value
+                long_positions = my_account.get_long_positions()
+                for stock in long_positions.ids:
+                    account_value = my_account.get_account_value(date)
+                    target_value = config['position_percent'] * account_value
+                    current_price = quote_manager.get_quote(stock, date)
+                    value = abs(my_account.get_position_value(stock, date))
+                    diff_value = target_value - value
+                    if diff_value > current_price:
+                        record_order(stock, order_manager.buy(diff_value, stock, date))
+                        log('Bought some more of %s because its value falls below the target percent of portfolio' % symbols[stock])
+                        new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
+                        log('New % of portfolio for {}: {:.3}'.format(symbols[stock], new_comp))
+
+                #TODO: This rebalance action is not working, find out why
+                # Short more of stock on gdx list that is below the target percent of account value
+                short_positions = my_account.get_short_positions()
+                for stock in short_positions.ids:
+                    account_value = my_account.get_account_value(date)
+                    target_value = config['position_percent'] * account_value
+                    current_price = quote_manager.get_quote(stock, date)
+                    value = abs(my_account.get_position_value(stock, date))
+                    diff_value = target_value - value
+                    if diff_value > current_price:
+                        record_order(stock, order_manager.short(diff_value, stock, date))
+                        log('Shorted some more of %s because its value falls below the target percent of portfolio' % symbols[stock])
+                        new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
+                        log('New % of portfolio for {}: {:.3}'.format(symbols[stock], new_comp))
+
+                # Short stock that no longer appears on undervalued list that is on gdx list
+                for stock in new_top_gdx:
+                    account_value = my_account.get_account_value(date)
+                    target_value = config['position_percent'] * account_value
+                    if my_account.get_qty(stock) >= 0:
+                        record_order(stock, order_manager.short(target_value, stock, date))
+                        log('Shorted %s because it is now on the gdx list' % symbols[stock])
+
+            # Shift variables for next rebalance
+            undervalued_stock = new_undervalued
+            top_gdx = new_top_gdx
+
+            # Store transaction and account data from this rebalance
+            old_long_value = my_account.get_long_value(date)
+
+            old_short_value = my_account.get_short_value(date)
+
+            old_date = date
+
+            # Keep the holdings after trading to mark the account to market until the next rebalance
+            held = my_account.get_positions()
+            held_ids = np.flatnonzero(held.qty)
+            recorder.record_holdings(date, my_account.get_cash_value(), held.index[held_ids],
+                                     held.qty[held_ids], held.price[held_ids])
+
+            # Put this rebalance's rows on disk, so a crash loses at most the rebalance in progress
+            if writer is not None:
+                writer.flush()
+
+            # Save the state reached at this rebalance along with everything recorded up to it
+            if checkpoint_path is not None:
+                checkpoints.save(cursor, join_state(account  = my_account.get_state(),
+                                                    orders   = order_manager.get_state(),
+                                                    recorder = recorder.get_state(),
+                                                    run      = {'cursor'          : cursor,
+                                                                'old_long_value'  : old_long_value,
+                                                                'old_short_value' : old_short_value}))
+            # END REBALANCE CODE
+
+        history, self.positions, orders = recorder.to_frames()
+        self.holdings = recorder.get_holdings()
+        return history, orders
+
+
+    def get_equity_curve(self, frequency='day'):
+        '''Returns a DataFrame of the Portfolio_Value, Cash, Long_Value and Short_Value
+        of the account on every quote date from the first to the last rebalance day of
+        the last run, sampled at the close of each frequency period (see rebalance_calendar).
+
+        Holdings don't change between rebalances, so each holding period is marked to
+        market with one product of the held quantities and a block of Adj_Close quotes.
+        A holding without a bar on a date is valued at its last quote before it.
+        A rebalance day shows the account after its trades, and the values are those
+        before the margin gains deposited at the next rebalance.'''
+        assert self.holdings is not None, "ERROR in Backtest.get_equity_curve() >> run() has not been called"
+        cash, holdings = self.holdings
+        quote_manager = self.quote_manager
+        dates = quote_manager.get_days()
+        columns = ['Portfolio_Value', 'Cash', 'Long_Value', 'Short_Value']
+        if len(holdings) == 0:
+            return pd.DataFrame(columns=columns)
+
+        # Each holding period runs from its rebalance day up to the next one
+        starts = np.searchsorted(dates, self.rebalance_days[:len(holdings)], side='left')
+        ends = np.append(starts[1:], np.searchsorted(dates, self.rebalance_days[len(holdings)-1], side='right'))
+        values = np.zeros((ends[-1] - starts[0], 3))
+        for i, (symbols, qty, price) in enumerate(holdings):
+            block = quote_manager.get_quote_matrix(symbols, dates[starts[i]:ends[i]], asof=True)
+            long = qty > 0
+            rows = slice(starts[i] - starts[0], ends[i] - starts[0])
+            values[rows, 0] = cash[i]
+            values[rows, 1] = block[:, long].dot(qty[long])
+            # A short position gains what the price has fallen from the average short price
+            values[rows, 2] = 2 * price[~long].dot(qty[~long]) - block[:, ~long].dot(qty[~long])
+
+        curve = pd.DataFrame(values, index=to_date_strings(dates[starts[0]:ends[-1]]), columns=columns[1:])
+        curve.insert(0, 'Portfolio_Value', curve.Cash + curve.Long_Value + curve.Short_Value.abs())
+        if frequency != 'day':
+            curve = curve.iloc[get_rebalance_positions(curve.index, frequency)]
+        return curve
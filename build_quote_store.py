@@ -0,0 +1,16 @@
+import numpy as np
+from quote_manager import QuoteManager
+
+# File Paths
+DB_FILEPATH     = 'data/daily_gold.db'
+STORE_PATH      = 'data/daily_gold_store'
+
+# Parameters
+STORE_DTYPE     = np.float64                # Use np.float32 to halve the size of the store
+
+
+# Convert the quote database into memory-mapped arrays that QuoteManager.from_store() can open
+if __name__ == '__main__':
+    quote_manager = QuoteManager(DB_FILEPATH, dtype=STORE_DTYPE)
+    quote_manager.save_store(STORE_PATH)
+    print("Quote store written to %s" % STORE_PATH)
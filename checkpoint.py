@@ -0,0 +1,113 @@
+import hashlib
+import os
+import numpy as np
+
+
+# Hash any mix of arrays and values that repr() describes fully
+def get_hash(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            sha.update(repr((part.dtype.str, part.shape)).encode('utf-8'))
+            sha.update(np.ascontiguousarray(part).tobytes())
+        else:
+            sha.update(repr(part).encode('utf-8'))
+    return sha.hexdigest()
+
+
+# Hash the contents of source files, so a change to the code they hold changes the hash
+def get_source_hash(paths):
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+# Chain the hashes of consecutive blocks of data so each one covers every block up to it
+def chain_hashes(blocks):
+    hashes = []
+    previous = ''
+    for block in blocks:
+        previous = get_hash(previous, *block)
+        hashes.append(previous)
+    return hashes
+
+
+class CheckpointStore(object):
+    """Saves and finds the simulation state at rebalance boundaries.
+
+    The checkpoints of a run live in a folder named by the hash of its config, one
+    np.savez_compressed file per rebalance day named by the day and the hash of the
+    input data up to and including it.  A checkpoint is only found again while both
+    hashes match, so appending new data keeps earlier checkpoints valid while a
+    change to old data or to the config does not.
+
+    Only the latest checkpoint of a config is kept, along with the latest one on a
+    closed day.  A day that isn't closed, like a rebalance day ending a partial
+    period, may no longer be a checkpoint day once new data is appended, and the
+    run then resumes from the closed checkpoint before it.
+    """
+
+
+    def __init__(self, path, config_hash, days, data_hashes, closed=None):
+        '''closed marks the days that stay checkpoint days when data is appended, every
+        day by default.'''
+        assert len(days) == len(data_hashes), \
+            "ERROR in CheckpointStore.__init__() >> one data hash is needed per day"
+        self.path = os.path.join(path, config_hash)
+        self.days = list(days)
+        self.data_hashes = list(data_hashes)
+        self.closed = [True] * len(self.days) if closed is None else list(closed)
+        return super(CheckpointStore, self).__init__()
+
+
+    def _get_file(self, i):
+        return os.path.join(self.path, '%s_%s.npz' % (self.days[i], self.data_hashes[i]))
+
+
+    def save(self, i, state):
+        '''Writes the state dict of arrays reached at the close of day i.'''
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # Write to a temporary file and swap it in so a crash never leaves a partial checkpoint
+        tmp_file = self._get_file(i) + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez_compressed(f, **state)
+        if os.path.exists(self._get_file(i)):
+            os.remove(self._get_file(i))
+        os.rename(tmp_file, self._get_file(i))
+
+        # The earlier checkpoints are superseded once this one is in place, but for the
+        #   latest closed one, which is resumed from when day i stops being a checkpoint day
+        keep = [self._get_file(j) for j in range(i + 1) if self.closed[j]][-1:] + [self._get_file(i)]
+        for name in os.listdir(self.path):
+            if name.endswith('.npz') and os.path.join(self.path, name) not in keep:
+                os.remove(os.path.join(self.path, name))
+
+
+    def load_latest(self):
+        '''Returns the index of the latest day with a valid checkpoint and its state,
+        or -1 and None when there is none.'''
+        for i in reversed(range(len(self.days))):
+            if os.path.exists(self._get_file(i)):
+                with np.load(self._get_file(i), allow_pickle=False) as arrays:
+                    return i, dict((name, arrays[name]) for name in arrays.files)
+        return -1, None
+
+
+# Split a flat checkpoint state back into the states saved under each prefix
+def split_state(state, prefixes):
+    return dict((prefix, dict((name[len(prefix) + 1:], value) for name, value in state.items()
+                              if name.startswith(prefix + '.')))
+                for prefix in prefixes)
+
+
+# Join the states of several objects into one flat dict for np.savez
+def join_state(**states):
+    joined = {}
+    for prefix, state in states.items():
+        for name, value in state.items():
+            joined[prefix + '.' + name] = value
+    return joined
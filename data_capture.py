@@ -1,36 +1,100 @@
 
 
-import urllib,datetime,sqlite3 as lite,data_processing#, pandas as pd
+import urllib,urllib2,urlparse,datetime,sqlite3 as lite,data_processing,quote_db#, pandas as pd
+import socket,threading,time
+from multiprocessing.pool import ThreadPool
 from datetime import timedelta, date
+import numpy as np
+from rebalance_calendar import to_date_strings
 #from pandas import *
 
 class Ticker(object):
+    ''' Quotes of one symbol held in typed NumPy columns.
+
+    Each bar has an int64 timestamp of seconds since 1970-01-01 and float64 prices and
+    int64 volume.  The columns are buffers that double in capacity when full so bars
+    can be appended one at a time, and are read as arrays of the bars held, e.g.
+    ticker.close.  Bars are kept in time order, so a bar is found by binary search. '''
     
     DATE_FMT = '%Y-%m-%d'
     TIME_FMT = '%H:%M:%S'
+    EPOCH = datetime.datetime(1970,1,1)
+    COLUMNS = [('timestamp', np.int64), ('open_', np.float64), ('high', np.float64), ('low', np.float64),
+               ('close', np.float64), ('volume', np.int64), ('adj_close', np.float64)]
   
     def __init__(self):
         self.symbol = ''
         self.db_path = ''
-        self.date,self.time,self.date_time,self.open_,self.high,self.low,self.close,self.volume,self.adj_close = ([] for _ in range(9))
+        self.clear()
+
+    def clear(self, capacity=64):
+        self._columns = dict((name, np.zeros(capacity, dtype=dtype)) for name, dtype in self.COLUMNS)
+        self._count = 0
+
+    def __getattr__(self, name):
+        # Columns are read as views of the part of their buffer holding bars
+        columns = self.__dict__.get('_columns')
+        if columns is None or name not in columns:
+            raise AttributeError(name)
+        return columns[name][:self._count]
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def date_time(self):
+        return self.timestamp.astype('datetime64[s]')
+
+    @property
+    def date(self):
+        return self.date_time.astype('datetime64[D]')
+
+    def _reserve(self, extra):
+        capacity = len(self._columns['timestamp'])
+        if self._count + extra > capacity:
+            capacity = max(2 * capacity, self._count + extra)
+            for name, column in self._columns.items():
+                self._columns[name] = np.resize(column, capacity)
 
     def append(self,dt,open_,high,low,close,volume,adj_close):
-        self.date.append(dt.date())
-        self.time.append(dt.time())
-        self.date_time.append(dt)
-        self.open_.append(float(open_))
-        self.high.append(float(high))
-        self.low.append(float(low))
-        self.close.append(float(close))
-        self.volume.append(int(volume))
-        self.adj_close.append(float(adj_close))
+        self._reserve(1)
+        bar = self._count
+        self._columns['timestamp'][bar] = int((dt - self.EPOCH).total_seconds())
+        self._columns['open_'][bar] = float(open_)
+        self._columns['high'][bar] = float(high)
+        self._columns['low'][bar] = float(low)
+        self._columns['close'][bar] = float(close)
+        self._columns['volume'][bar] = int(volume)
+        self._columns['adj_close'][bar] = float(adj_close)
+        self._count += 1
+
+    def extend(self, timestamp, open_, high, low, close, volume, adj_close):
+        ''' Appends arrays of bars, taking timestamps as datetime64 values or seconds '''
+        timestamp = np.asarray(timestamp)
+        if np.issubdtype(timestamp.dtype, np.datetime64):
+            timestamp = timestamp.astype('datetime64[s]').astype(np.int64)
+        count = len(timestamp)
+        self._reserve(count)
+        rows = slice(self._count, self._count + count)
+        for name, values in zip([name for name, _ in self.COLUMNS],
+                                [timestamp, open_, high, low, close, volume, adj_close]):
+            self._columns[name][rows] = values
+        self._count += count
+
+    def find_after(self, dt):
+        ''' Returns the index of the first bar after datetime dt '''
+        return int(np.searchsorted(self.timestamp, int((dt - self.EPOCH).total_seconds()), side='right'))
+
+    def get_datetime(self, i):
+        return self.EPOCH + timedelta(seconds=int(self.timestamp[i]))
       
     def to_csv(self):
-        return ''.join(["{0},{1},{2},{3:.2f},{4:.2f},{5:.2f},{6:.2f},{7},{8:.2f}\n".format(self.symbol,
-                        self.date[bar].strftime('%Y-%m-%d'),self.time[bar].strftime('%H:%M:%S'),
-                        self.open_[bar],self.high[bar],self.low[bar],self.close[bar],self.volume[bar],
-                        self.adj_close[bar]) 
-                        for bar in xrange(len(self.close))])
+        stamps = np.datetime_as_string(self.date_time).astype(str)
+        return ''.join(["%s,%s,%s,%.2f,%.2f,%.2f,%.2f,%d,%.2f\n" % (self.symbol, stamp[:10], stamp[11:],
+                        open_, high, low, close, volume, adj_close)
+                        for stamp, open_, high, low, close, volume, adj_close in
+                        zip(stamps, self.open_.tolist(), self.high.tolist(), self.low.tolist(),
+                            self.close.tolist(), self.volume.tolist(), self.adj_close.tolist())])
     
     def write_csv(self,filename):
         with open(filename,'w') as f:
@@ -38,27 +102,35 @@ class Ticker(object):
    
     def read_csv(self,filename):
         self.symbol = ''
-        self.date,self.time,self.date_time,self.open_,self.high,self.low,self.close,self.volume = ([] for _ in range(8))
-        for line in open(filename,'r'):
-            symbol,ds,ts,open_,high,low,close,volume = line.rstrip().split(',')
-            self.symbol = symbol
-            dt = datetime.datetime.strptime(ds+' '+ts,self.DATE_FMT+' '+self.TIME_FMT)
-            self.append(dt,open_,high,low,close,volume)
+        self.clear()
+        with open(filename,'r') as f:
+            rows = [line.rstrip().split(',') for line in f if line.strip()]
+        if rows:
+            self.symbol = rows[-1][0]
+            self._extend_rows([row[1] + 'T' + row[2] for row in rows], [row[3:] for row in rows])
         return True
     
     def read_yahoo_csv(self,csv_path,ticker):
         self.symbol = ''
-        self.date,self.time,self.date_time,self.open_,self.high,self.low,self.close,self.volume,self.adj_close = ([] for _ in range(9))
-        f = open(csv_path,'r')
-        f.next()
-        for line in f:
-            ds,open_,high,low,close,volume,adj_close = line.rstrip().split(',')
+        self.clear()
+        with open(csv_path,'r') as f:
+            f.next()
+            rows = [line.rstrip().split(',') for line in f if line.strip()]
+        if rows:
             self.symbol = ticker
-            ts = '0:00:00'
-            dt = datetime.datetime.strptime(ds+' '+ts,self.DATE_FMT+' '+self.TIME_FMT)
-            self.append(dt,open_,high,low,close,volume,adj_close)
+            self._extend_rows([row[0] for row in rows], [row[1:7] for row in rows])
         return True
 
+    def _extend_rows(self, stamps, values):
+        ''' Appends ISO date or datetime strings and rows of open, high, low, close,
+        volume and adj_close text, converted column by column '''
+        if not stamps:
+            return
+        values = np.array(values, dtype=str).T
+        self.extend(np.array(stamps, dtype='datetime64[s]'), values[0].astype(float), values[1].astype(float),
+                    values[2].astype(float), values[3].astype(float), values[4].astype(float).astype(np.int64),
+                    values[5].astype(float))
+
 #    def read_db(self,db_path,ticker):
 ##        ticker_ = '[' + ticker + ']'
 #        self.symbol = ''
@@ -81,13 +153,19 @@ class Ticker(object):
     def read_last_quote(self,db_path,ticker):
         ticker_ = '[' + ticker + ']'
         self.symbol = ''
-        self.date,self.time,self.date_time,self.open_,self.high,self.low,self.close,self.volume,self.adj_close = ([] for _ in range(9))
+        self.clear(1)
         con = lite.connect(db_path)
         try:
             with con:
                 cur = con.cursor()
-                cur.execute('SELECT * FROM %s ORDER BY Datetime DESC LIMIT 1' % ticker_)
-                lq = cur.fetchone()
+                if quote_db.is_normalized(con):
+                    cur.execute('SELECT day, open, close, high, low, volume, adj_close FROM quotes WHERE symbol_id = '
+                                '(SELECT symbol_id FROM symbols WHERE symbol = ?) ORDER BY day DESC LIMIT 1', (ticker,))
+                    lq = cur.fetchone()
+                    lq = (to_date_strings([lq[0]])[0],) + lq[1:]
+                else:
+                    cur.execute('SELECT * FROM %s ORDER BY Datetime DESC LIMIT 1' % ticker_)
+                    lq = cur.fetchone()
                 dt,open_,close,high,low,volume,adj_close = lq[0],lq[1],lq[2],lq[3],lq[4],lq[5],lq[6]
                 self.symbol = ticker
                 self.db_path = db_path
@@ -108,7 +186,6 @@ class Ticker(object):
                                      int(hour), int(minute), int(second))
         
     def overwrite_db(self,db_path=None):
-        f = '{0:02d}'
         if db_path==None:
             if   'daily'   in self.db_path: intraday = False
             elif 'minutes' in self.db_path: intraday = True
@@ -116,116 +193,73 @@ class Ticker(object):
         else:
             self.db_path = db_path
             intraday = False
-        ticker = '[' + self.symbol + ']'
-        con = lite.connect(self.db_path)
-        with con:
-            stockvalues = []
-            for i in range(len(self.date_time)):
-                d = self.date[i]
-                t = self.time[i]
-                if intraday:
-                    dt_int = (str(d.year) + '_' + f.format(d.month) + '_' +
-                            f.format(d.day) + '_' + f.format(t.hour) + '_' + 
-                            f.format(t.minute) + '_' + f.format(t.second))
-                else:
-                    dt_int = (str(d.year) + '_' + f.format(d.month) + '_' + f.format(d.day))
-                    
-                stockvalues.append((dt_int,
-                                    self.open_[i],
-                                    self.close[i],
-                                    self.high[i],
-                                    self.low[i],
-                                    self.volume[i],
-                                    self.adj_close[i]))
-            stockvalues = tuple(stockvalues)
-            cur = con.cursor()
-            cur.execute("DROP TABLE IF EXISTS %s" % ticker)
-            cur.execute("CREATE TABLE %s(Datetime INT, Open REAL, Close REAL, High REAL, Low REAL, Volume INT, Adj_Close REAL)" % ticker)
-            sqlite_string = "INSERT INTO %s VALUES(?, ?, ?, ?, ?, ?, ?)" % ticker
-            cur.executemany(sqlite_string, stockvalues)
-            
-#            cur.execute("SELECT * FROM %s" % ticker)
-
-#            while True:
-#                row = cur.fetchone()
-#                if row == None:
-#                    break
-#                print row[0], row[1], row[2],row[3], row[4], row[5]
+        with QuoteWriter(self.db_path, intraday) as writer:
+            writer.write(self, overwrite=True)
 
     def update_db(self):
-        f = '{0:02d}'
         if   'daily'   in self.db_path: intraday = False
         elif 'minutes' in self.db_path: intraday = True
         else: return False
-        ticker = '[' + self.symbol + ']'
-        con = lite.connect(self.db_path)
-        with con:
-            stockvalues = []
-            while len(self.open_) > 0:
-                d = self.date.pop(0)
-                t = self.time.pop(0)
-                self.date_time.pop(0)
-                if intraday:
-                    dt_int = (str(d.year) + '_' + f.format(d.month) + '_' +
-                            f.format(d.day) + '_' + f.format(t.hour) + '_' + 
-                            f.format(t.minute) + '_' + f.format(t.second))
-                else:
-                    dt_int = (str(d.year) + '_' + f.format(d.month) + '_' + f.format(d.day))
-                    
-                stockvalues.append((dt_int,
-                                    self.open_.pop(0),
-                                    self.close.pop(0),
-                                    self.high.pop(0),
-                                    self.low.pop(0),
-                                    self.volume.pop(0),
-                                    self.adj_close.pop(0)))
-            stockvalues = tuple(stockvalues)
-            cur = con.cursor()
-            sqlite_string = "INSERT INTO %s VALUES(?, ?, ?, ?, ?, ?, ?)" % ticker
-            cur.executemany(sqlite_string, stockvalues)
-            
-#            cur.execute("SELECT * FROM %s" % ticker)
-
-#            while True:
-#                row = cur.fetchone()
-#                if row == None:
-#                    break
-#                print row[0], row[1], row[2],row[3], row[4], row[5]
+        with QuoteWriter(self.db_path, intraday) as writer:
+            writer.write(self)
+        # The quotes are consumed once they are stored
+        self.trim(len(self))
     
+    def get_rows(self, intraday=False):
+        ''' Returns the quotes as (Datetime, Open, Close, High, Low, Volume, Adj_Close) rows '''
+        if intraday:
+            stamps = np.datetime_as_string(self.date_time).astype(str)
+            stamps = [stamp.replace('-', '_').replace('T', '_').replace(':', '_') for stamp in stamps]
+        else:
+            stamps = to_date_strings(self.timestamp // 86400)
+        return zip(stamps, self.open_.tolist(), self.close.tolist(), self.high.tolist(), self.low.tolist(),
+                   self.volume.tolist(), self.adj_close.tolist())
+
+    def get_day_rows(self, symbol_id):
+        ''' Returns the quotes as rows of the normalized quotes table of quote_db '''
+        return zip([symbol_id] * len(self), (self.timestamp // 86400).tolist(),
+                   self.open_.tolist(), self.high.tolist(), self.low.tolist(), self.close.tolist(),
+                   self.volume.tolist(), self.adj_close.tolist())
+
+    def trim(self, start):
+        ''' Drops the quotes before index start '''
+        start = min(start, self._count)
+        for name, column in self._columns.items():
+            self._columns[name] = column[start:]
+        self._count -= start
+
     def delete_quote_by_index(self,i):
-        self.date_time.pop(i)
-        self.date.pop(i)
-        self.time.pop(i)
-        self.open_.pop(i)
-        self.close.pop(i)
-        self.high.pop(i)
-        self.low.pop(i)
-        self.volume.pop(i)
-        self.adj_close.pop(i)
+        for name, column in self._columns.items():
+            self._columns[name] = np.delete(column[:self._count], i)
+        self._count -= 1
         self.overwrite_db()
         return True
         
     def get_quote_by_index(self,i):
-        quote = (self.date_time[i], self.open_[i], self.close[i], 
+        quote = (self.get_datetime(i), self.open_[i], self.close[i], 
                  self.high[i],      self.low[i],   self.volume[i], self.adj_close[i])
         return quote
         
     def __repr__(self):
         return self.to_csv()
 
+def fetch_lines(url):
+    return urllib.urlopen(url).readlines()
+
 class IntradayQuotes(Ticker):
   ''' Intraday quotes from Google. Specify interval seconds and number of days '''
-  def __init__(self,symbol,interval_seconds=300,num_days=5):
+  URL = 'http://www.google.com/finance/getprices'
+  def __init__(self,symbol,interval_seconds=300,num_days=5,fetch=fetch_lines,base_url=None):
     super(IntradayQuotes,self).__init__()
     self.symbol = symbol.upper()
     self.db_path = 'data/minutes_1.db'
-    url_string = "http://www.google.com/finance/getprices?q={0}".format(self.symbol)
+    url_string = "{0}?q={1}".format(base_url or self.URL, self.symbol)
     url_string += "&i={0}&p={1}d&f=d,o,h,l,c,v".format(interval_seconds,num_days)
     if interval_seconds < 60:
         s_o = 60 / interval_seconds #special offset for less than 60s intervals
     else:
         s_o = 1
-    csv = urllib.urlopen(url_string).readlines()
+    csv = fetch(url_string)
     for bar in xrange(7,len(csv)):
       if csv[bar].count(',')!=5: continue
       offset,close,high,low,open_,volume = csv[bar].split(',')
@@ -241,11 +275,16 @@ class IntradayQuotes(Ticker):
 
 class DailyQuotes(Ticker):
     ''' Daily quotes from Google. Date format='yyyy-mm-dd' '''
+    URLS = {'yahoo' : 'http://real-chart.finance.yahoo.com/table.csv',
+            'google': 'http://www.google.com/finance/historical'}
+
     def __init__(self,symbol,
                  start_date=datetime.datetime(1970,1,1),
                  end_date=datetime.date.today().isoformat(),
                  source='yahoo',
-                 db_path='data/daily_gold.db'):
+                 db_path='data/daily_gold.db',
+                 fetch=fetch_lines,
+                 base_url=None):
                      
         super(DailyQuotes,self).__init__()
         self.symbol = symbol.upper()
@@ -257,18 +296,18 @@ class DailyQuotes(Ticker):
         
         end = datetime.date(int(end_date[0:4]),int(end_date[5:7]),int(end_date[8:10]))
         if source == 'yahoo':
-            url_string = 'http://real-chart.finance.yahoo.com/table.csv?s=%s' % self.symbol
+            url_string = '%s?s=%s' % (base_url or self.URLS[source], self.symbol)
             url_string += '&a=%s&b=%s&c=%s&' % (start.month, start.day, start.year)
             url_string += 'd=%s&e=%s&f=%s&g=d&ignore=.csv' % (end.month, end.day, end.year)
         elif source == 'google':
-            url_string = "http://www.google.com/finance/historical?q={0}".format(self.symbol)
+            url_string = "{0}?q={1}".format(base_url or self.URLS[source], self.symbol)
             url_string += "&startdate={0}&enddate={1}&output=csv".format(
                           start.strftime('%b %d, %Y'),end.strftime('%b %d, %Y'))
         else:
             print("Must select 'yahoo' or 'google' for source!")
             return
         
-        csv = urllib.urlopen(url_string).readlines()
+        csv = fetch(url_string)
         csv.reverse()
         if 'head' not in csv and '</div></body></html>\n' not in csv:
 #            print("DOWNLOADED GARBAGE\n%s\n%s\n%s" %('='*88, csv, '='*88))
@@ -289,8 +328,188 @@ class DailyQuotes(Ticker):
                     dt = datetime.datetime.strptime(ds,'%d-%b-%y')
                     self.append(dt,open_,high,low,close,volume)
 
+class HostRateLimiter(object):
+    ''' Spaces out requests to each host so no host sees more than max_rate requests per second '''
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self._next_times = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.max_rate:
+            return
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_times.get(host, now))
+            self._next_times[host] = start + 1. / self.max_rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class QuoteDownloader(object):
+    ''' Downloads the quotes of many symbols at once on a pool of threads.
+
+    At most max_workers requests are open at a time and each host gets at most
+    max_rate requests per second.  A request that times out, fails to connect or
+    gets a 429 or 5xx response is retried up to retries times, waiting backoff
+    seconds before the first retry and doubling the wait before each next one.
+    base_url replaces the quote source url, e.g. to point at a local test server. '''
+
+    def __init__(self, max_workers=8, timeout=10., retries=3, backoff=.5, max_rate=5., base_url=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.base_url = base_url
+        self.rate_limiter = HostRateLimiter(max_rate)
+
+    def fetch(self, url):
+        ''' Returns the lines of a url, retrying transient errors '''
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait(url)
+            try:
+                return urllib2.urlopen(url, timeout=self.timeout).readlines()
+            except urllib2.HTTPError as e:
+                if e.code != 429 and e.code < 500 or attempt == self.retries:
+                    raise
+            except (urllib2.URLError, socket.error, socket.timeout):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def download(self, symbols, make_ticker):
+        ''' Yields (symbol, ticker, error) for each symbol as its download completes, where
+        make_ticker(symbol, fetch, base_url) returns the Ticker and error is None unless it failed '''
+        def run(symbol):
+            try:
+                return symbol, make_ticker(symbol, self.fetch, self.base_url), None
+            except Exception as e:
+                return symbol, None, e
+
+        pool = ThreadPool(self.max_workers)
+        try:
+            for result in pool.imap_unordered(run, symbols):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def download_daily(self, symbols, start_date='1970-01-01', end_date=None, source='yahoo'):
+        ''' Yields (symbol, DailyQuotes, error) for each symbol as its download completes '''
+        end_date = end_date or datetime.date.today().isoformat()
+        return self.download(symbols, lambda symbol, fetch, base_url:
+                             DailyQuotes(symbol, start_date, end_date, source, fetch=fetch, base_url=base_url))
+
+    def download_intraday(self, symbols, interval_seconds=300, num_days=5):
+        ''' Yields (symbol, IntradayQuotes, error) for each symbol as its download completes '''
+        return self.download(symbols, lambda symbol, fetch, base_url:
+                             IntradayQuotes(symbol, interval_seconds, num_days, fetch=fetch, base_url=base_url))
+
+
+class QuoteWriter(object):
+    ''' Bulk writes the quotes of many tickers through one connection.
+
+    The database is switched to WAL journaling with synchronous=NORMAL, a cache of
+    cache_mb and in-memory temp storage, and rows are inserted with executemany in
+    transactions of about chunk_rows rows, so large rebuilds are bound by disk I/O.
+    close() commits and checkpoints the WAL back into the database file.
+
+    Daily quotes are written to the normalized quotes and symbols tables of quote_db
+    unless the database already holds one table per symbol, which is kept until it
+    is migrated.  Intraday quotes are always written one table per symbol. '''
+
+    TABLE_SCHEMA = "(Datetime INT, Open REAL, Close REAL, High REAL, Low REAL, Volume INT, Adj_Close REAL)"
+
+    def __init__(self, db_path, intraday=False, chunk_rows=500000, cache_mb=64):
+        self.db_path = db_path
+        self.intraday = intraday
+        self.chunk_rows = chunk_rows
+        self.con = lite.connect(db_path, isolation_level=None)
+        self.cur = self.con.cursor()
+        self.cur.execute("PRAGMA journal_mode=WAL")
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+        self.cur.execute("PRAGMA cache_size=-%d" % (cache_mb * 1024))
+        self.cur.execute("PRAGMA temp_store=MEMORY")
+        self._pending = 0
+        tables = self.cur.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        self.normalized = not intraday and (len(tables) == 0 or quote_db.is_normalized(self.con))
+        if self.normalized:
+            quote_db.create_schema(self.con)
+
+    def write(self, ticker, overwrite=False):
+        ''' Replaces the ticker's quotes if overwrite else adds its quotes to them '''
+        if self._pending == 0:
+            self.cur.execute("BEGIN")
+        if self.normalized:
+            self._write_normalized(ticker, overwrite)
+            return
+        table = '[' + ticker.symbol + ']'
+        if overwrite:
+            self.cur.execute("DROP TABLE IF EXISTS %s" % table)
+        self.cur.execute("CREATE TABLE IF NOT EXISTS %s%s" % (table, self.TABLE_SCHEMA))
+        rows = ticker.get_rows(self.intraday)
+        self.cur.executemany("INSERT INTO %s VALUES(?, ?, ?, ?, ?, ?, ?)" % table, rows)
+        self._pending += len(rows) + 1
+        if self._pending >= self.chunk_rows:
+            self.commit()
+
+    def _write_normalized(self, ticker, overwrite):
+        symbol_id = quote_db.get_symbol_id(self.con, ticker.symbol)
+        if overwrite:
+            self.cur.execute("DELETE FROM quotes WHERE symbol_id = ?", (symbol_id,))
+        rows = ticker.get_day_rows(symbol_id)
+        self.cur.executemany("INSERT OR REPLACE INTO quotes VALUES(?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._pending += len(rows) + 1
+        if self._pending >= self.chunk_rows:
+            self.commit()
+
+    def commit(self):
+        if self._pending > 0:
+            self.cur.execute("COMMIT")
+            self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._pending > 0:
+            self.cur.execute("ROLLBACK")
+            self._pending = 0
+        self.close()
+
+
+def write_quotes(tickers, db_path, overwrite=False, intraday=False, chunk_rows=500000):
+    ''' Inserts the quotes of many tickers with a QuoteWriter, replacing each ticker's
+    table if overwrite else appending to it '''
+    with QuoteWriter(db_path, intraday, chunk_rows) as writer:
+        for ticker in tickers:
+            writer.write(ticker, overwrite)
+
+
+def write_downloads(results, db_path, overwrite=False, intraday=False, chunk_rows=500000):
+    ''' Writes the tickers yielded by QuoteDownloader from this one thread through one
+    QuoteWriter as they arrive.  Returns the lists of symbols written and failed '''
+    written, failed = [], []
+    with QuoteWriter(db_path, intraday, chunk_rows) as writer:
+        for symbol, ticker, error in results:
+            if error is not None or len(ticker) == 0:
+                failed.append(symbol)
+                print("%s: DATA MISSING!!! %s" % (symbol, error or ''))
+                continue
+            writer.write(ticker, overwrite)
+            written.append(symbol)
+            print("%s: %s" % (symbol, len(ticker)))
+    return written, failed
+
+
 ### Works with YAHOO only
-def download_latest_quotes(type_='daily', time_frame=360):
+def download_latest_quotes(type_='daily', time_frame=360, downloader=None):
     empties = []
     
     if type_ == 'daily':
@@ -307,62 +526,49 @@ def download_latest_quotes(type_='daily', time_frame=360):
         
     if type_ == 'daily':   
         print("Begining %s..." % time_cat)
+        path = ("data/%s.db" % time_cat)
     else:
         print("Begining %s %s..." % (interval, time_cat))
-    
+        path = ("data/%s_%s.db" % (time_cat, interval_print))
+    intraday = type_ != 'daily'
+
+    # Download every ticker at once, then sort the new quotes out from this one thread
+    if downloader is None:
+        downloader = QuoteDownloader()
     tickers, rand_state = data_processing.load_tickers()
-    for ticker in tickers:
-        t1 = Ticker()
-        spaces = abs(len(ticker)-5) * ' '
-        tickerPrint = ticker + spaces
-            
-        print("-\n%s>> " % tickerPrint),
-        print("downloading... "),
-        if type_ == 'daily':
-            t2 = DailyQuotes(ticker,time_frame)
-        else:
-            t2 = IntradayQuotes(ticker, interval, time_frame)
-            
-        if len(t2.date) == 0: 
-            empties.append(t2.symbol)
-            print("DATA MISSING!!!")
+    if type_ == 'daily':
+        results = downloader.download_daily(tickers, time_frame.isoformat())
+    else:
+        results = downloader.download_intraday(tickers, interval, time_frame)
+
+    updates, new_tickers = [], []
+    for ticker, t2, error in results:
+        if error is not None or len(t2) == 0:
+            empties.append(ticker)
+            print("%s>> DATA MISSING!!! %s" % (ticker, error or ''))
             continue
-        
-        print("checking ours... "),
-        if type_ == 'daily':
-            path = ("data/%s.db" % time_cat)
-        else:
-            path = ("data/%s_%s.db" % (time_cat, interval_print))
+
+        t1 = Ticker()
         if t1.read_last_quote(path,ticker):
             #we don't load everything from the ticker only the last quote into t1
-            #we then only pop the quote in t2 if it is older or equal to the last quote in t1
-            #When we find the first new quote in t2 we stop and run update_db on t2
-            print("updating..."),
-            additions = 0
-            while len(t2.date) > 0:
-                if t2.date_time[0] > t1.date_time[-1]:
-                    additions = len(t2.date)
-                    t2.update_db()
-                    break
-                else:
-                    t2.date.pop(0)
-                    t2.time.pop(0)
-                    t2.date_time.pop(0)
-                    t2.open_.pop(0)
-                    t2.close.pop(0)
-                    t2.high.pop(0)
-                    t2.low.pop(0)
-                    t2.volume.pop(0)
-                    t2.adj_close.pop(0)
-            print("%s... " % additions),
+            #we then only keep the quotes in t2 newer than the last quote in t1
+            t2.trim(t2.find_after(t1.get_datetime(-1)))
+            if len(t2) > 0:
+                updates.append(t2)
+            print("%s>> updating... %s... " % (ticker, len(t2)))
         else:#ticker table doesn't exist so download all history available
-            if type_ == 'daily':
-                t2 = DailyQuotes(ticker,'1970-01-01')
-            else:
-                t2 = IntradayQuotes(ticker, interval, 360)
-            print("new ticker added... "),
-            t2.overwrite_db()
-        print("COMPLETE!!")
+            new_tickers.append(ticker)
+    write_quotes(updates, path, intraday=intraday)
+
+    if new_tickers:
+        print("new tickers added... %s" % new_tickers)
+        if type_ == 'daily':
+            results = downloader.download_daily(new_tickers, '1970-01-01')
+        else:
+            results = downloader.download_intraday(new_tickers, interval, 360)
+        written, failed = write_downloads(results, path, overwrite=True, intraday=intraday)
+        empties += failed
+    print("COMPLETE!!")
     print("These were not downloaded: %s" % empties)
 #download_latest_quotes('daily', 180)
 #download_latest_quotes('minutes')
@@ -380,21 +586,20 @@ if __name__ == '__main__':
     gdx_tickers, rand_state = load_tickers(validate=False, db_path=db_path, ticker_path=gdx_path, min_samples=1)
     all_tickers = picks_tickers + gdx_tickers + ['SPY']
 
+    max_workers = 8                     # Number of downloads open at once
+    max_rate = 5.                       # Maximum requests per second sent to the quote source
+    base_url = None                     # Quote source url, None for the default of DailyQuotes
+
     print "Downloading Stock Prices!"
-    for symbol in all_tickers:
-        t1 = DailyQuotes(symbol     = symbol,
-                         start_date = '2007-09-23',  # '2007-09-23'  '2016-11-1'
-                         db_path    = db_path)
-
-        print("%s: %s" % (symbol, len(t1.date)))
-
-        if len(t1.date) > 1: 
-            if create_db_from_scratch:
-                t1.overwrite_db()
-                print("Table %s has been deleted and recreated in database %s." % (symbol, db_path))
-            else:
-                t1.update_db()
-                print("Table %s has been updated in database %s." % (symbol, db_path))
+    downloader = QuoteDownloader(max_workers=max_workers, max_rate=max_rate, base_url=base_url)
+    results = downloader.download_daily(all_tickers,
+                                        start_date = '2007-09-23')  # '2007-09-23'  '2016-11-1'
+    written, failed = write_downloads(results, db_path, overwrite=create_db_from_scratch)
+    if create_db_from_scratch:
+        print("Tables %s have been deleted and recreated in database %s." % (written, db_path))
+    else:
+        print("Tables %s have been updated in database %s." % (written, db_path))
+    print("These were not downloaded: %s" % failed)
 
 
     ### A DailyQuotes object downloads quote data from yahoo during init
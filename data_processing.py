@@ -4,15 +4,17 @@ import csv
 import numpy as np
 import random
 #import cPickle
-#import os
+import os
 #from datetime import datetime, timedelta
 from pytz import timezone
+import pandas as pd
+import data_quality
+import quote_db
 
 PICKS_CSV_PATH = 'symbols/gold_picks.csv'
 GDX_CSV_PATH = 'symbols/gold_gdx.csv'
 DB_FILEPATH = 'data/daily_gold.db'
 MIN_STOCK_PRICE_HISTORY = 1
-f = "{:.2f}"
 time_zone = timezone('US/Eastern')
 time_fmt = '%Y-%m-%d %H:%M:%S %Z%z'
 
@@ -45,18 +47,14 @@ def load_tickers( randomize     = False,                    # Should the selctio
         # Remove tickers if their history is too short or they don't exist in db
         if validate:
             con = lite.connect(db_path)
-            for t in tickers:
-                try:
-                    with con:
-                        cur = con.cursor()
-                        cur.execute('SELECT COUNT(*) FROM [%s]' % t)
-                        count = cur.fetchone()[0]
-                        if count < min_samples:
-                            print ('Table too short: %s' % t)
-                            tickers.remove(t)
-                except:
+            counts = quote_db.get_row_counts(con)
+            for t in list(tickers):
+                if t not in counts:
                     #print ('Table not found: %s' % t)
                     tickers.remove(t)
+                elif counts[t] < min_samples:
+                    print ('Table too short: %s' % t)
+                    tickers.remove(t)
 
         #if ticker_count is passed as a < 1 value then convert to percent of all tickers
         if ticker_count <= 1 and ticker_count > 0: ticker_count = int(ticker_count * len(tickers)+0.5)
@@ -74,125 +72,41 @@ def load_tickers( randomize     = False,                    # Should the selctio
 #print test_tickers
 
         
-def check_missing_dates(db_path,ticker,print_res=True):
-    t1 = data_capture.Ticker()
-    t1.read_all(db_path,ticker)
-    missing = []
-    missing.append(ticker)
-    missing_int = 0
-    deleted = 0
-    print('%s...'% ticker),
-    i = 0
-    for i in range(len(t1.date)-1):
-        i -= deleted #adjusts index to account for deleted duplicate quotes
-        if t1.date[i].isoweekday() == 5: # 5 is friday
-            time_delta_int = 3
-        else:
-            time_delta_int = 1
-        date1 = t1.date[i] + timedelta(days=time_delta_int)
-        year,month,day,dow = date1.year, date1.month, date1.day, date1.isoweekday()
-        if date1 != t1.date[i+1]:
-            #check if it's a duplicate entry
-            if t1.date[i] == t1.date[i+1]:
-                print('\nFOUND DUPLICATE ENTRY!!')
-                print(t1.get_quote_by_index(i))
-                print(t1.get_quote_by_index(i+1))
-                while True:
-                    answer = raw_input("Delete first(1), second(2), or neither(3)? ")
-                    if answer == '1':
-                        t1.delete_quote_by_index(i)
-                        deleted += 1
-                        break
-                    elif answer == '2':
-                        t1.delete_quote_by_index(i+1)
-                        deleted += 1
-                        break
-                    elif answer == '3':
-                        break
-                    else:
-                        print('Your response [%s] was not an option. Try again!'% answer)
-                continue
-            #unless its thanksgiving
-            elif month == 11 and day > 21 and day < 29 and dow == 4:
-                continue
-            #unless its martin luther king day
-            elif month == 1 and day > 14 and day < 22 and dow == 1:
-                continue
-            #unless its labor day
-            elif month == 9 and day > 0 and day < 8 and dow == 1:
-                continue
-            #unless its president's day
-            elif month == 2 and day > 14 and day < 22 and dow == 1:
-                continue
-            #unless its memorial day
-            elif month == 5 and day > 24 and day < 32 and dow == 1:
-                continue
-            #unless its 9-11
-            elif year == 2001 and month == 9 and day == 11:
-                continue
-            #unless its the 4th of july
-            elif month == 7 and day > 2 and day < 6:
-                continue
-            #unless its new years
-            elif month == 1 and day > 0 and day < 3:
-                continue
-            #unless its christmas
-            elif month == 12 and day > 23 and day < 27:
-                continue
-            else:
-                missing_int +=1
-                missing.append((year, month, day, dow))
-                if print_res: print(i, year, month, day, dow)
-    if print_res: print("Total Missing %s" % missing_int)
+def check_missing_dates(db_path,ticker,print_res=True,duplicates='report'):
+    '''Returns the ticker followed by the (year, month, day, isoweekday) of each exchange
+    day missing from its quotes.  Duplicate dates are resolved by the duplicates policy
+    of data_quality.scan_quotes() instead of asking.'''
+    report = data_quality.scan_db(db_path, [ticker], processes=1, duplicates=duplicates)
+    missing = [ticker] + [(d.year, d.month, d.day, d.isoweekday()) for d in
+                          pd.to_datetime(report.date[report.issue == 'missing'], format='%Y_%m_%d')]
+    if print_res:
+        print(report.to_string())
+        print("Total Missing %s" % (len(missing) - 1))
     return missing
 #missing = check_missing_dates('data/daily_gold.db','A')
     
 def check_erratic_values(db_path,ticker,print_res=True,erratic_index=10):
-    '''Checks for missing values and drastic changes from one quote to the next'''
-    t1 = data_capture.Ticker()
-    t1.read_all(db_path,ticker)
-    global f
-    erratics = []
-    erratics.append(ticker)
-    erratic_cnt = 0
-    for i in range(len(t1.date)-1):
-#        o,c,h,l,v = t1.open_[i], t1.close[i], t1.high[i], t1.low[i], t1.volume[i]
-        q1 = t1.get_quote_by_index(i)
-        q2 = t1.get_quote_by_index(i+1)
-        changes = []
-        adj = 0
-        erratic_bool = False
-        for j in range(1,len(q1)):
-            if q1[j] == 0 or q2[j] == 0:
-                erratic_bool= True
-                adj = 0.001#prevent div by 0
-            chng = float(abs(q2[j] - q1[j]))/(q1[j]+adj) * 100
-            chng = f.format(chng)
-            changes.append(chng)
-        for change in changes[0:-1]:
-            if float(change) > erratic_index: 
-                erratic_bool = True
-        if erratic_bool:
-            erratic_cnt += 1
-            erratics.append((q1,q2,changes))
-            if print_res: print(erratics[-1])
-            
-    if print_res: print("Total Erratics %s" % erratic_cnt)
+    '''Returns the zero, missing and jumping prices of ticker as a data_quality report'''
+    report = data_quality.scan_db(db_path, [ticker], processes=1, jump_percent=erratic_index)
+    erratics = report[report.issue.isin(['zero', 'jump'])]
+    if print_res:
+        print(erratics.to_string())
+        print("Total Erratics %s" % len(erratics))
     return erratics
 #erratics = check_erratic_values('data/daily_gold.db','A',erratic_index=40)
     
 def check_missing_dates_from_list(db_name='daily'):
-    missing = []
+    '''Returns the data_quality report of every ticker, scanned across a pool of processes'''
     tickers,rand_state = load_tickers()
     db_path = 'data/%s.db'% db_name
     print('\nChecking for missing dates from %s...'% db_path)
-    for ticker in tickers:
-        missing.append(check_missing_dates(db_path,ticker,print_res=False))
-    return missing
+    report = data_quality.scan_db(db_path, tickers)
+    return report[report.issue == 'missing']
 #missing1 = check_missing_dates_from_list('daily')
 #missing2 = check_missing_dates_from_list('minutes_1')
     
 def convert_csv_to_db(time_cat, db_name,intraday=True):
+    import data_capture
     empties = []
     additions = 0
     
@@ -203,26 +117,28 @@ def convert_csv_to_db(time_cat, db_name,intraday=True):
         tickers = np.asarray(tickers).transpose()
         print("Begining %s..." % (time_cat))
     
-    for ticker in tickers[0]:
-        t1 = data_capture.Ticker()
-        spaces = abs(len(ticker)-5) * ' '
-        tickerPrint = ticker + spaces
+    # Every table is rebuilt through one connection in a few large transactions
+    with data_capture.QuoteWriter(db_name, intraday) as writer:
+        for ticker in tickers[0]:
+            t1 = data_capture.Ticker()
+            spaces = abs(len(ticker)-5) * ' '
+            tickerPrint = ticker + spaces
+                
+            print("-\n%s>> " % tickerPrint),
             
-        print("-\n%s>> " % tickerPrint),
-        
-        print("reading csv... "),
-        path = ("data/%s/%s.csv" % (time_cat, ticker))
-        if os.path.exists(path):
-            t1.read_csv(path)
-            print("writing to db..."),
-            t1.overwrite_sqlite(db_name,ticker,intraday)
-            additions +=1
-
-            print("%s... " % additions),
-        else:
-            empties.append(ticker)
-            print("no csv found..."),
-        print("COMPLETE!!")
+            print("reading csv... "),
+            path = ("data/%s/%s.csv" % (time_cat, ticker))
+            if os.path.exists(path):
+                t1.read_csv(path)
+                print("writing to db..."),
+                writer.write(t1, overwrite=True)
+                additions +=1
+    
+                print("%s... " % additions),
+            else:
+                empties.append(ticker)
+                print("no csv found..."),
+            print("COMPLETE!!")
     print("These were not converted: %s" % empties)
 #convert_csv_to_db('daily','data/daily_gold.db',False)
 #convert_csv_to_db('minutes_1','data/minutes_1.db',True)
@@ -0,0 +1,203 @@
+import datetime
+import multiprocessing
+import sqlite3 as lite
+import numpy as np
+import pandas as pd
+import quote_db
+from rebalance_calendar import get_exchange_days, to_date_strings, to_days
+
+# File Paths
+DB_FILEPATH     = 'data/daily_gold.db'
+REPORT_PATH     = 'output/'
+
+# Parameters
+PROCESSES       = None                      # Number of worker processes, None for one per CPU
+DUPLICATES      = 'report'                  # Of bars sharing a timestamp keep the 'first' or 'last' stored, or only 'report' them
+JUMP_PERCENT    = 10.                       # Percent change from one bar to the next reported as a jump
+JUMP_COLUMNS    = ['open', 'high', 'low', 'close']  # Price columns checked for jumps and zero or missing values
+CALENDAR_START  = '1970-01-01'              # First day of the exchange calendar quotes are checked against
+
+# Duplicate bars are resolved without asking, by one of these policies
+DUPLICATE_POLICIES = ['report', 'first', 'last']
+
+# Each finding is one row of the report
+REPORT_COLUMNS = ['symbol', 'date', 'issue', 'column', 'value', 'action']
+
+# Columns of a symbol's quotes in the order they are read and written
+COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'adj_close']
+
+
+# Settings shared by every scan in a worker process, set once per worker by _init_worker()
+_scan_data = None
+
+
+# Read the quotes of one symbol from either database layout, in the order they are stored
+def read_symbol(con, symbol):
+    '''Returns an int64 array of bar timestamps in seconds since 1970-01-01, a dict of
+    the COLUMNS arrays and whether the bars are intraday.'''
+    if quote_db.is_normalized(con):
+        rows = con.execute("SELECT day, open, high, low, close, volume, adj_close FROM quotes WHERE symbol_id = "
+                           "(SELECT symbol_id FROM symbols WHERE symbol = ?) ORDER BY day", (symbol,)).fetchall()
+        stamps = np.array([row[0] for row in rows], dtype=np.int64) * 86400
+        intraday = False
+    else:
+        rows = con.execute("SELECT Datetime, Open, High, Low, Close, Volume, Adj_Close FROM [%s] ORDER BY rowid"
+                           % symbol).fetchall()
+        dates = [str(row[0]) for row in rows]
+        intraday = any(len(date) > 10 for date in dates)
+        if intraday:
+            dates = [date[:10].replace('_', '-') + 'T' + date[11:].replace('_', ':') for date in dates]
+            stamps = np.array(dates, dtype='datetime64[s]').astype(np.int64)
+        else:
+            stamps = to_days(dates).astype(np.int64) * 86400
+    values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), len(COLUMNS))
+    return stamps, dict(zip(COLUMNS, values.T)), intraday
+
+
+def format_stamps(stamps, intraday=False):
+    '''Returns the 'YYYY_MM_DD' or, for intraday bars, 'YYYY_MM_DD_HH_MM_SS' strings of timestamps.'''
+    if not intraday:
+        return to_date_strings(np.asarray(stamps) // 86400)
+    stamps = np.datetime_as_string(np.asarray(stamps, dtype=np.int64).astype('datetime64[s]')).astype(str)
+    return [stamp.replace('-', '_').replace('T', '_').replace(':', '_') for stamp in stamps]
+
+
+# Find every problem in the quotes of one symbol with array operations over all its bars
+def scan_quotes(symbol, stamps, values, exchange_days, duplicates=DUPLICATES, jump_percent=JUMP_PERCENT,
+                jump_columns=JUMP_COLUMNS, intraday=False):
+    '''Returns a list of REPORT_COLUMNS findings and a boolean array of the bars to keep,
+    in the order stamps were passed.
+
+    Bars sharing a timestamp are duplicates, resolved by the duplicates policy.  Days of
+    exchange_days between the first and last bar without a bar are missing, and bars on
+    days the exchange is closed are off_calendar.  Prices that are zero, negative or
+    missing are zero, and prices changing more than jump_percent from the bar kept
+    before them are a jump.'''
+    assert duplicates in DUPLICATE_POLICIES, \
+        "ERROR in scan_quotes() >> duplicates must be one of %s, not %s" % (DUPLICATE_POLICIES, duplicates)
+    findings = []
+    order = np.argsort(stamps, kind='mergesort')
+    stamps = stamps[order]
+    if len(stamps) == 0:
+        return findings, np.zeros(0, dtype=bool)
+
+    # Bars sharing a timestamp are grouped together by the stable sort, in stored order
+    starts = np.flatnonzero(np.r_[True, stamps[1:] != stamps[:-1]])
+    counts = np.diff(np.r_[starts, len(stamps)])
+    if duplicates == 'first':
+        keep = np.zeros(len(stamps), dtype=bool)
+        keep[starts] = True
+    elif duplicates == 'last':
+        keep = np.zeros(len(stamps), dtype=bool)
+        keep[starts + counts - 1] = True
+    else:
+        keep = np.ones(len(stamps), dtype=bool)
+    action = {'report': '', 'first': 'kept first', 'last': 'kept last'}[duplicates]
+    repeated = starts[counts > 1]
+    findings += [(symbol, date, 'duplicate', '', count, action) for date, count in
+                 zip(format_stamps(stamps[repeated], intraday), counts[counts > 1].tolist())]
+
+    # Check the days quoted against the exchange calendar over the span of the quotes
+    days = np.unique(stamps // 86400)
+    span = exchange_days[np.searchsorted(exchange_days, days[0]):np.searchsorted(exchange_days, days[-1], 'right')]
+    missing = span[~np.in1d(span, days, assume_unique=True)]
+    findings += [(symbol, date, 'missing', '', np.nan, '') for date in to_date_strings(missing)]
+    inside = (days >= exchange_days[0]) & (days <= exchange_days[-1])
+    closed = days[inside & ~np.in1d(days, exchange_days, assume_unique=True)]
+    findings += [(symbol, date, 'off_calendar', '', np.nan, '') for date in to_date_strings(closed)]
+
+    # Compare the prices of each kept bar with the kept bar before it
+    kept = order[keep]
+    dates = None
+    for column in jump_columns:
+        prices = values[column][kept]
+        bad = ~(prices > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = (prices[1:] / prices[:-1] - 1.) * 100.
+        jumps = np.flatnonzero(~bad[1:] & ~bad[:-1] & (abs(change) > jump_percent)) + 1
+        if not bad.any() and len(jumps) == 0:
+            continue
+        if dates is None:
+            dates = format_stamps(stamps[keep], intraday)
+        findings += [(symbol, dates[i], 'zero', column, prices[i], '') for i in np.flatnonzero(bad)]
+        findings += [(symbol, dates[i], 'jump', column, change[i-1], '') for i in jumps]
+
+    keep_stored = np.empty(len(order), dtype=bool)
+    keep_stored[order] = keep
+    return findings, keep_stored
+
+
+def _init_worker(db_path, exchange_days, settings):
+    # Every worker reads through its own connection
+    global _scan_data
+    _scan_data = (lite.connect(db_path), exchange_days, settings)
+
+
+def _scan_symbol(symbol):
+    con, exchange_days, settings = _scan_data
+    stamps, values, intraday = read_symbol(con, symbol)
+    findings, keep = scan_quotes(symbol, stamps, values, exchange_days, intraday=intraday, **settings)
+    # Only the quotes of symbols with bars to drop are sent back to be written
+    if keep.all():
+        return findings, None
+    kept = np.flatnonzero(keep)
+    kept = kept[np.argsort(stamps[kept], kind='mergesort')]
+    return findings, (symbol, intraday, stamps[kept], dict((column, values[column][kept]) for column in COLUMNS))
+
+
+def write_fixes(db_path, fixes):
+    '''Rewrites the quotes of each (symbol, intraday, stamps, values) fix through one writer.'''
+    import data_capture
+    for intraday in (False, True):
+        group = [fix for fix in fixes if fix[1] == intraday]
+        if not group:
+            continue
+        with data_capture.QuoteWriter(db_path, intraday) as writer:
+            for symbol, _, stamps, values in group:
+                ticker = data_capture.Ticker()
+                ticker.symbol = symbol
+                ticker.extend(stamps, *[values[column] for column in COLUMNS])
+                writer.write(ticker, overwrite=True)
+
+
+def scan_db(db_path=DB_FILEPATH, symbols=None, processes=PROCESSES, duplicates=DUPLICATES,
+            jump_percent=JUMP_PERCENT, jump_columns=JUMP_COLUMNS, report_path=None):
+    '''Scans the quotes of symbols, or every symbol in the database, across a pool of
+    processes and returns one DataFrame of REPORT_COLUMNS findings, ordered by symbol.
+    Duplicates dropped by the duplicates policy are deleted from the database, and the
+    report is also written as a CSV file to report_path when it is passed.'''
+    assert duplicates in DUPLICATE_POLICIES, \
+        "ERROR in scan_db() >> duplicates must be one of %s, not %s" % (DUPLICATE_POLICIES, duplicates)
+    con = lite.connect(db_path)
+    if symbols is None:
+        symbols = sorted(quote_db.get_row_counts(con))
+    con.close()
+    exchange_days = get_exchange_days(CALENDAR_START, datetime.date.today().isoformat())
+    settings = {'duplicates': duplicates, 'jump_percent': jump_percent, 'jump_columns': jump_columns}
+
+    if processes == 1:
+        _init_worker(db_path, exchange_days, settings)
+        results = [_scan_symbol(symbol) for symbol in symbols]
+        _scan_data[0].close()
+    else:
+        # Symbols are handed out in chunks, several per worker so the workers finish together
+        chunksize = max(1, len(symbols) // (8 * (processes or multiprocessing.cpu_count())))
+        pool = multiprocessing.Pool(processes, _init_worker, (db_path, exchange_days, settings))
+        try:
+            results = pool.map(_scan_symbol, symbols, chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Resolved duplicates are written from this process so the database has one writer
+    write_fixes(db_path, [fix for _, fix in results if fix is not None])
+    report = pd.DataFrame([finding for findings, _ in results for finding in findings], columns=REPORT_COLUMNS)
+    if report_path is not None:
+        report.to_csv(report_path, index=False)
+    return report
+
+
+if __name__ == '__main__':
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    report = scan_db(report_path=REPORT_PATH + 'quality_{}.csv'.format(timestamp))
+    print(report.groupby('issue').size().to_string())
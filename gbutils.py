@@ -1,100 +1,119 @@
 import numpy as np
 import pandas as pd
+from rebalance_calendar import get_rebalance_days, to_days
 
 
 # Get top GDX component stock based on greatest market value but excluding exclude_stock 
 def get_top_gdx(gdx_components, quote_manager, exclude_stock=None, count=10):
+    assert exclude_stock is not None, 'Error in get_top_gdx(): exclude_stock is None'
 
     # Grab date from exclude_stock for checking quote data exists
     date = exclude_stock.name
 
-    # Remove and symbols that don't have quote data available for current date
-    gdx_refined = gdx_components.copy()
-    for i in gdx_refined.index:
-        if quote_manager.get_quote(gdx_refined[i], date.replace('-', '_')) == 'nan':
-            gdx_refined = gdx_refined.drop(i)
-
-    assert exclude_stock is not None, 'Error in get_top_gdx(): exclude_stock is None'
-    diff = gdx_refined[~gdx_refined.isin(exclude_stock.index)]
-
-    if len(diff) > count:
-        return diff[:count]
+    ids = quote_manager.get_symbol_ids(gdx_components.values)
+    picks = select_top_gdx(ids, quote_manager, date, quote_manager.get_symbol_ids(exclude_stock.index), count)
+    return gdx_components.iloc[picks]
+
+
+# Get the positions in gdx_ids of the top GDX component stock of a date, all by symbol id
+def select_top_gdx(gdx_ids, quote_manager, date, exclude_ids, count=10):
+    # Keep symbols that have quote data available for the date and are not excluded
+    keep = quote_manager.get_availability(gdx_ids, [date]) & ~np.in1d(gdx_ids, exclude_ids)
+    picks = select_first(keep, count)[0]
+    return picks[picks >= 0]
+
+
+# Select the first count True columns of every row of a mask, keeping column order
+def select_first(mask, count=10):
+    '''Returns a (rows x count) array of column positions of mask, padded with -1 where
+    a row has fewer than count True values.'''
+    mask = np.asarray(mask, dtype=bool)
+    n_rows, n_columns = mask.shape
+    count = min(count, n_columns)
+    position = np.cumsum(mask, axis=1)
+    rows, columns = np.nonzero(mask & (position <= count))
+    picks = np.full((n_rows, count), -1, dtype=np.intp)
+    picks[rows, position[rows, columns] - 1] = columns
+    return picks
+
+
+# Rank the lowest signal values of every date in one pass over the signals matrix
+def rank_signals(signals, available, count=10):
+    '''Returns a (dates x count) array of signals column positions ordered from lowest
+    signal up, padded with -1 where fewer than count symbols have a signal and a quote.
+    available is a boolean (dates x symbols) array aligned with signals.'''
+    values = np.asarray(signals, dtype=np.float64)
+    valid = ~np.isnan(values) & available
+    keys = np.where(valid, values, np.inf)
+    n_dates, n_symbols = keys.shape
+    count = min(count, n_symbols)
+
+    # Partition to find the count-th lowest signal of each row, then take every signal
+    #   below it and as many ties as fit, breaking ties by column order
+    rows = np.arange(n_dates)[:, np.newaxis]
+    if 0 < count < n_symbols:
+        kth = keys[rows, np.argpartition(keys, count-1, axis=1)[:, count-1:count]]
+        ties = keys == kth
+        take = (keys < kth) | (ties & (np.cumsum(ties, axis=1) <= count - (keys < kth).sum(axis=1)[:, np.newaxis]))
+        picks = np.nonzero(take)[1].reshape(n_dates, count)
     else:
-        if len(diff) == 0: 
-            print("NO VALID GDX COMPONENT STOCK FOUND FOR DATE: %s" % date)
-        return diff
+        picks = np.tile(np.arange(count), (n_dates, 1))
 
+    # Sort only the picks, keeping column order among ties
+    picks = picks[rows, np.argsort(keys[rows, picks], axis=1, kind='mergesort')]
 
-# Get undervalued stock based on lowest signal value for a given date
-def get_undervalued(signals, date, quote_manager, count=10):
-    # Grab the signals for the date in question and order them 
-    day_signals = signals.loc[date.replace('_', '-')].order()
-    day_signals_no_nans = day_signals[:day_signals.last_valid_index()]
-
-    # Remove and symbols that don't have quote data available for current date
-    for symbol in day_signals_no_nans.index:
-        if quote_manager.get_quote(symbol, date) == 'nan':
-            day_signals_no_nans = day_signals_no_nans.drop(symbol)
-         
-    # TODO: Return top 10 even if not negative? Currently yes.
-    if len(day_signals_no_nans) > count:
-        return day_signals_no_nans[:count]
-    else:
-        if len(day_signals_no_nans) == 0: 
-            print("NO VALID UNDERVALUED STOCK FOUND FOR DATE: %s" % date)
-        return day_signals_no_nans
+    # Blank out picks beyond the number of valid symbols on each date
+    n_valid = valid.sum(axis=1)[:, np.newaxis]
+    return np.where(np.arange(count) < n_valid, picks, -1)
 
 
-# Get next rebalance day without affecting whats_left list
-def get_next_rebal_day(whats_left, period):
-
-    # This loop iterates through signal days until the close of month is reached
-    #   and iterates through months until the period is reached
-    for _ in range(period):
+class SignalRanking(object):
+    """Undervalued stock of every rebalance date, ranked once so each lookup is an array index"""
 
-        # Iterate through days until end of month is reached
-        i = 0
-        while True:
 
-            # Grab the next day of signal values
-            whats_next = whats_left[i]
-            year, month = whats_next[:4], whats_next[5:7]
+    def __init__(self, signals, quote_manager, count=10):
+        '''signals holds one row per date to rank, indexed by day numbers or dates.'''
+        self.signals = signals
+        self.count = count
+        self._days = to_days(signals.index)
+        self._date_ids = dict((day, i) for i, day in enumerate(self._days.tolist()))
+        self._symbol_ids = quote_manager.get_symbol_ids(signals.columns)
+        available = quote_manager.get_availability(self._symbol_ids, self._days)
+        self._picks = rank_signals(signals.values, available, count)
+        return super(SignalRanking, self).__init__()
 
-            # Get month close values by making sure the following day is a new month or year
-            if year != whats_left[i+1][:4] or month != whats_left[i+1][5:7]:
-                # Then break from intra-month loop
-                break
 
-            i += 1
+    def get_undervalued_ids(self, date):
+        '''Returns the array of symbol ids of the undervalued stock for a date, lowest
+        signal first.'''
+        picks = self._picks[self._date_ids[int(to_days([date])[0])]]
+        return self._symbol_ids[picks[picks >= 0]]
 
-    return whats_next
 
+    def get_undervalued(self, date):
+        '''Returns the signals of the undervalued stock for a date, lowest first, named
+        by the day number of the date.'''
+        row = self._date_ids[int(to_days([date])[0])]
+        picks = self._picks[row]
+        picks = picks[picks >= 0]
+        return pd.Series(self.signals.values[row, picks], index=self.signals.columns[picks],
+                         name=self._days[row])
 
-# Find rebalance days at a monthly frequency set by period
-def get_rebal_days(whats_left, period):
-    rebalance_days = []
-    while whats_left:
 
-        # This loop iterates through signal days until the close of month is reached
-        #   and iterates through months until the period is reached
-        for _ in range(period):
+# Get undervalued stock based on lowest signal value for a given date
+def get_undervalued(signals, date, quote_manager, count=10):
+    row = np.flatnonzero(to_days(signals.index) == to_days([date])[0])
+    return SignalRanking(signals.iloc[row], quote_manager, count).get_undervalued(date)
 
-            # Iterate through days until end of month is reached
-            while True:
 
-                # Grab the next day of signal values
-                whats_now = whats_left.pop(0)
-                year, month = whats_now[:4], whats_now[5:7]
+# Get next rebalance day without affecting whats_left list
+def get_next_rebal_day(whats_left, period):
+    return get_rebalance_days(whats_left, 'month', period)[0]
 
-                # Get month close values by making sure the following day is a new month or year
-                if len(whats_left) <= 0 or year != whats_left[0][:4] or month != whats_left[0][5:7]:
-                    # Then break from intra-month loop
-                    break
-    
-        # Add to rebalance days
-        rebalance_days.append(whats_now)
 
-    return rebalance_days
+# Find rebalance days at a monthly frequency set by period
+def get_rebal_days(whats_left, period):
+    return get_rebalance_days(whats_left, 'month', period)
 
 
 # Get change in value
@@ -1,9 +1,8 @@
 import pandas as pd
-from gbutils import *
-from account_manager import AccountManager
-from order_manager import OrderManager
+import analytics
+from backtest import Backtest, load_signals
+from history_writer import HistoryWriter
 from quote_manager import QuoteManager
-import matplotlib.pyplot as plt
 
 # File Paths
 PICKS_CSV_PATH  = 'symbols/gold_picks.csv'
@@ -13,7 +12,8 @@ SIGNALS_PATH    = 'signals/signal_data.csv'
 OUTPUT_PATH     = 'output/'
 
 # Parameters
-REBAL_PERIOD    = 1                         # Number of months between rebalance
+REBAL_FREQUENCY = 'month'                   # Rebalance at the close of each 'day', 'week', 'month', 'quarter', 'year' or on a list of dates
+REBAL_PERIOD    = 1                         # Number of REBAL_FREQUENCY periods between rebalance
 START_BALANCE   = 100000.                   # Starting cash balance in portfolio
 MARGIN_PERCENT  = 100.                      # The margin account size as a percent of account value
 START_DAY       = '2008_01_02'              # Day of initial stock purchases  'YYYY_MM_DD' ex '2016_01_04' '2008_01_02'
@@ -21,245 +21,119 @@ COMMISSION      = .005                      # Cost in dollars per share traded
 COMMISSION_MIN  = 1.                        # Minimum cost in dollars per stock traded
 COMMISSION_MAX  = .005                      # Maximum cost in percent of trade value
 SLIPPAGE        = .01                       # Average slippage in price due to market volatility
+LONG_COUNT      = 10                        # Number of undervalued stock held long
+SHORT_COUNT     = 10                        # Number of top GDX stock held short
+POSITION_PERCENT = .05                      # Target value of each position as a percent of account value
+BATCH_REBALANCE = False                     # Trade to target weights in one batch instead of the sequential rules
+LAZY_QUOTES     = False                     # Load each symbol's quotes on first use instead of all at start
+QUOTE_MEMORY_MB = None                      # Memory cap in MB for lazily loaded quotes, None for no cap
+QUOTE_STORE_PATH = None                     # Folder written by build_quote_store.py to map instead of DB_FILEPATH
+QUOTE_CACHE_PATH = 'data/quote_cache/'      # Folder for snapshots of the loaded quotes, None to always read DB_FILEPATH
+QUOTE_CALENDAR  = None                      # Dates the quotes are aligned to, 'exchange' for NYSE days, None for every quoted date
+QUOTE_FILL      = None                      # Fill dates without a quote by 'ffill' from the last bar or 'asof' its close, None for NaN
+QUOTE_FILL_LIMIT = None                     # Most dates a bar fills forward, None for no limit
+OUTPUT_FORMATS  = ['csv', 'columnar']       # Formats the metrics, positions and trades are streamed to during the run
+CHECKPOINT_PATH = 'data/checkpoints/'       # Folder for the state saved at each rebalance to resume from, None to always run in full
 
 #COMMISSION      = .0                        # Cost in dollars per share traded
 #COMMISSION_MIN  = .0                        # Minimum cost in dollars per stock traded
 #COMMISSION_MAX  = .0                        # Maximum cost in percent of trade value
 #SLIPPAGE        = .0                        # Average slippage in price due to market volatility
 
-
-# Create QuoteManager object
-quote_manager = QuoteManager(DB_FILEPATH)
-
-# Create AccountManager object
-my_account = AccountManager(START_BALANCE, MARGIN_PERCENT, quote_manager)
-
-# Create OrderManager object
-order_manager = OrderManager(quote_manager, 
-                             my_account,
-                             slippage       = SLIPPAGE,
-                             commission_min = COMMISSION_MIN,
-                             commission     = COMMISSION,
-                             commission_max = COMMISSION_MAX
-                             )
-
-# Create an order_history DataFrame
-order_history = {}
-
-# Load signals data
-signals = pd.read_csv(SIGNALS_PATH, index_col=0)
-signal_dates = [date.replace('-', '_') for date in signals.index]
-
-# Load GDX component symbols
-gdx_symbols = pd.read_csv(GDX_CSV_PATH).symbol
-gdx_symbols = gdx_symbols[gdx_symbols.isin(signals.columns)]
-
-# Skip days until START_DAY is found
-while signal_dates[0] != START_DAY: signal_dates.pop(0)
-
-# Create variables to store data from the backtest to be saved in output folder
-index = ['Portfolio_Value', 'Cash', 'Long_Value', 'Short_Value', 'Total_Return', 'Long_Return', 'Short_Return'] + \
-        ['Long_Position {}'.format(i+1) for i in range(10)] + \
-        ['Short_Position {}'.format(i+1) for i in range(10)] + \
-        ['Trade_{}'.format(i+1) for i in range(40)] 
-history = pd.DataFrame(index=index)
-
-# Get month close rebalance days determined by REBAL_PERIOD
-rebalance_days = get_rebal_days(signal_dates, REBAL_PERIOD)
-
-# Perform rebalancing every REBAL_PERIOD of months
-old_date        = None
-old_long_value  = None
-for date in rebalance_days:
-
-    print(" "*60 + date)
-
-    # Get total and 5 percent of account value
-    pre_account_value = my_account.get_account_value(date)
-    cash = my_account.get_cash_value()
-
-    # Get undervalued_stock for current date
-    new_undervalued = get_undervalued(signals, date, quote_manager)
-
-    # Get top gdx stock excluding undervalued_stock for current date
-    new_top_gdx = get_top_gdx(gdx_symbols, quote_manager, new_undervalued)
-    
-    # Get positions for calculating unrealized returns
-    long_positions = my_account.get_long_positions().index
-    long_value = my_account.get_long_value(date)
-
-    short_positions = my_account.get_short_positions().index
-    short_value = my_account.get_short_value(date)
-
-    # Get unrealized returns
-    if old_long_value != None:
-
-        # Add margin returns
-        margin_long_gains = long_value - old_long_value
-        margin_short_gains = abs(short_value) - abs(old_short_value)
-        my_account.deposit_cash(margin_long_gains + margin_short_gains)
-
-        # Adjust long and short values for margin returns
-        long_value += margin_long_gains
-        short_value -= margin_short_gains
-
-        # Calculate long and short returns
-        long_return = get_return(long_value, old_long_value) * .5
-        short_return = get_return(short_value, old_short_value) * .5
-        total_return = long_return + short_return
-    else:
-        long_return = 0
-        short_return = 0
-        total_return = 0
-
-    # Get account value adjusted for margin returns
-    account_value = my_account.get_account_value(date)
-        
-    history[date] = [account_value, cash, long_value, short_value, total_return, long_return, short_return] + \
-                    [(stock, my_account.get_position_value(stock, date)) for stock in long_positions]       + \
-                    ["" for _ in range(10-len(long_positions))]                                             + \
-                    [(stock, my_account.get_position_value(stock, date)) for stock in short_positions]      + \
-                    ["" for _ in range(10-len(short_positions))]                                            + \
-                    [(stock, order_results) for stock, order_results in order_history.iteritems()]          + \
-                    ["" for _ in range(40-len(order_history))]
-    
-    # Sell stock no longer on undervalued list
-    long_positions = my_account.get_long_positions()
-    for stock in long_positions.index:
-        if stock not in new_undervalued.index:
-            order_history[stock] = order_manager.sell_all(stock, date)
-            print('Sold %s because it is no longer on undervalued list' % stock)
-            
-    # Sell portion of stock on undervalued list that exceeds 5% of account value
-    long_positions = my_account.get_long_positions()
-    for stock in long_positions.index:
-        account_value = my_account.get_account_value(date)
-        five_percent_account = .05 * account_value
-        current_price = quote_manager.get_quote(stock, date)
-        value = abs(my_account.get_position_value(stock, date))
-        diff_value = value - five_percent_account
-        if diff_value > current_price:
-            order_history[stock] = order_manager.sell(diff_value + current_price, stock, date)
-            print('Sold some of %s because its value exceeds 5%% of portfolio' % stock)
-            new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
-            print('New % of portfolio for {}: {:.3}'.format(stock, new_comp))
-
-    # Cover stock that now appears on undervalued list and that no longer is on gdx list
-    short_positions = my_account.get_short_positions()
-    for stock in short_positions.index:
-        if stock in new_undervalued.index:
-            order_history[stock] = order_manager.cover_all(stock, date, )
-            print('Covered %s because it is now on undervalued list' % stock)
-        elif stock not in new_top_gdx:
-            order_history[stock] = order_manager.cover_all(stock, date)
-            print('Covered %s because it is no longer on gdx list' % stock)
-            
-    #TODO: This rebalance action is not working, find out why
-    # Cover portion of stock on gdx list that exceeds 5% of account value
-    short_positions = my_account.get_short_positions()
-    for stock in short_positions.index:
-        account_value = my_account.get_account_value(date)
-        five_percent_account = .05 * account_value
-        current_price = quote_manager.get_quote(stock, date)
-        value = abs(my_account.get_position_value(stock, date))
-        diff_value = value - five_percent_account
-        if diff_value > current_price:
-            order_history[stock] = order_manager.cover(diff_value + current_price, stock, date)
-            print('Covered some of %s because its value exceeds 5%% of portfolio' % stock)
-            new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
-            print('New % of portfolio for {}: {:.3}'.format(stock, new_comp))
-
-    # Buy stock new to undervalued list
-    long_positions = my_account.get_long_positions()
-    for stock in new_undervalued.index:
-        if stock not in long_positions.index:
-            account_value = my_account.get_account_value(date)
-            five_percent_account = .05 * account_value
-            order_history[stock] = order_manager.buy(five_percent_account, stock, date)
-            print('Bought %s because it is now on the undervalued list' % stock)
-
-    # Buy more of stock on undervalue list that is below 5% of account value
-    long_positions = my_account.get_long_positions()
-    for stock in long_positions.index:
-        account_value = my_account.get_account_value(date)
-        five_percent_account = .05 * account_value
-        current_price = quote_manager.get_quote(stock, date)
-        value = abs(my_account.get_position_value(stock, date))
-        diff_value = five_percent_account - value
-        if diff_value > current_price:
-            order_history[stock] = order_manager.buy(diff_value, stock, date)
-            print('Bought some more of %s because its value falls below 5%% of portfolio' % stock)
-            new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
-            print('New % of portfolio for {}: {:.3}'.format(stock, new_comp))
-
-    #TODO: This rebalance action is not working, find out why
-    # Short more of stock on gdx list that is below 5% of account value
-    short_positions = my_account.get_short_positions()
-    for stock in short_positions.index:
-        account_value = my_account.get_account_value(date)
-        five_percent_account = .05 * account_value
-        current_price = quote_manager.get_quote(stock, date)
-        value = abs(my_account.get_position_value(stock, date))
-        diff_value = five_percent_account - value
-        if diff_value > current_price:
-            order_history[stock] = order_manager.short(diff_value, stock, date)
-            print('Shorted some more of %s because its value falls below 5%% of portfolio' % stock)
-            new_comp = 100.0 * my_account.get_position_value(stock, date) / account_value
-            print('New % of portfolio for {}: {:.3}'.format(stock, new_comp))
-
-    # Short stock that no longer appears on undervalued list that is on gdx list
-    short_positions = my_account.get_short_positions()
-    for stock in new_top_gdx:
-        account_value = my_account.get_account_value(date)
-        five_percent_account = .05 * account_value
-        if stock not in short_positions.index:
-            order_history[stock] = order_manager.short(five_percent_account, stock, date)
-            print('Shorted %s because it is now on the gdx list' % stock)
-    
-    # Shift variables for next rebalance
-    undervalued_stock = new_undervalued
-    top_gdx = new_top_gdx
-    
-    # Store transaction and account data from this rebalance
-    old_long_value = my_account.get_long_value(date)
-
-    old_short_value = my_account.get_short_value(date)
-    
-    old_date = date
-    # END REBALANCE CODE
-
-# Handle stored data by saving files and showing graphs
-import time
-import datetime
-timestamp = str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S'))
-history.to_csv(OUTPUT_PATH + 'history_{}.csv'.format(timestamp))
-
-# Calculate Returns
-amlr = (history.loc['Long_Return'].sum() / len(history.loc['Long_Return'])) * 100.0
-amsr = (history.loc['Short_Return'].sum() / len(history.loc['Short_Return'])) * 100.0
-aalr = (12 * history.loc['Long_Return'].sum() / len(history.loc['Long_Return'])) * 100.0
-aasr = (12 * history.loc['Short_Return'].sum() / len(history.loc['Short_Return'])) * 100.0
-tlr  = history.loc['Long_Return'].sum() * 100.0
-tsr  = history.loc['Short_Return'].sum() * 100.0
-
-# Print Returns
-print("\n\n")
-print("Average Monthly Long Return  : {0:.2f}%".format(amlr))
-print("Average Monthly Short Return : {0:.2f}%".format(amsr))
-print("Average Annual Long Return   : {0:.2f}%".format(aalr))
-print("Average Annual Short Return  : {0:.2f}%".format(aasr))
-print("Total Long Return            : {0:.2f}%".format(tlr))
-print("Total Short Return           : {0:.2f}%".format(tsr))
-print("\n\n")
-print("Finished!")
-
-# Display Graphs
-spy_quotes = [quote_manager.get_quote('SPY', date) for date in history.columns]
-multiplier = START_BALANCE / spy_quotes[0]
-spy_quotes = [multiplier * price for price in spy_quotes]
-data_to_plot = pd.DataFrame()
-data_to_plot['Portfolio_Value'] = history.loc['Portfolio_Value']
-data_to_plot['SPY'            ] = spy_quotes
-plt.figure()
-data_to_plot.plot()
-plt.show()
+# Parameters of the backtest run, see backtest.DEFAULT_CONFIG
+CONFIG = {
+    'rebal_frequency'   : REBAL_FREQUENCY,
+    'rebal_period'      : REBAL_PERIOD,
+    'start_balance'     : START_BALANCE,
+    'margin_percent'    : MARGIN_PERCENT,
+    'start_day'         : START_DAY,
+    'commission'        : COMMISSION,
+    'commission_min'    : COMMISSION_MIN,
+    'commission_max'    : COMMISSION_MAX,
+    'slippage'          : SLIPPAGE,
+    'long_count'        : LONG_COUNT,
+    'short_count'       : SHORT_COUNT,
+    'position_percent'  : POSITION_PERCENT,
+    'batch_rebalance'   : BATCH_REBALANCE
+    }
+
+
+def load_quotes(signals, start_day=START_DAY):
+    '''Returns a QuoteManager holding the quotes between start_day and the last signal.'''
+    if QUOTE_STORE_PATH is not None:
+        return QuoteManager.from_store(QUOTE_STORE_PATH)
+    return QuoteManager(DB_FILEPATH,
+                        start_date      = start_day,
+                        end_date        = signals.index[-1],
+                        lazy            = LAZY_QUOTES,
+                        max_memory_mb   = QUOTE_MEMORY_MB,
+                        cache_path      = QUOTE_CACHE_PATH,
+                        calendar        = QUOTE_CALENDAR,
+                        fill            = QUOTE_FILL,
+                        fill_limit      = QUOTE_FILL_LIMIT
+                        )
+
+
+if __name__ == '__main__':
+
+    # Load signals, GDX component symbols and quotes
+    signals, gdx_symbols = load_signals(SIGNALS_PATH, GDX_CSV_PATH)
+    quote_manager = load_quotes(signals)
+
+    # Run the backtest with the parameters above, streaming metrics, positions and trades to the output folder
+    import time
+    import datetime
+    timestamp = str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S'))
+    writer = HistoryWriter(OUTPUT_PATH + 'run_{}_'.format(timestamp), formats=OUTPUT_FORMATS,
+                           symbol_width=max(len(symbol) for symbol in quote_manager.get_symbols()))
+    backtest = Backtest(CONFIG, quote_manager, signals, gdx_symbols)
+    try:
+        history, orders = backtest.run(writer=writer, checkpoint_path=CHECKPOINT_PATH)
+    finally:
+        writer.close()
+
+    # Handle stored data by saving files and showing graphs
+    history.to_csv(OUTPUT_PATH + 'history_{}.csv'.format(timestamp))
+    equity_curve = backtest.get_equity_curve()
+    equity_curve.to_csv(OUTPUT_PATH + 'equity_{}.csv'.format(timestamp))
+
+    # Calculate returns and performance statistics against SPY
+    dates = history.columns
+    periods_per_year = analytics.get_periods_per_year(dates)
+    spy_quotes = quote_manager.get_quote_matrix(['SPY'], dates)[:, 0]
+    traded_values = analytics.get_traded_values(dates, orders.date, orders.shares, orders.price)
+    stats = analytics.summarize(history.loc['Portfolio_Value'].values, dates,
+                                benchmark=spy_quotes, traded_values=traded_values)
+    apr = history.loc[['Long_Return', 'Short_Return']].values.mean(axis=1) * 100.0
+    tr  = history.loc[['Long_Return', 'Short_Return']].values.sum(axis=1) * 100.0
+
+    # Print Returns
+    print("\n\n")
+    print("Average Period Long Return   : {0:.2f}%".format(apr[0]))
+    print("Average Period Short Return  : {0:.2f}%".format(apr[1]))
+    print("Average Annual Long Return   : {0:.2f}%".format(apr[0] * periods_per_year))
+    print("Average Annual Short Return  : {0:.2f}%".format(apr[1] * periods_per_year))
+    print("Total Long Return            : {0:.2f}%".format(tr[0]))
+    print("Total Short Return           : {0:.2f}%".format(tr[1]))
+    print("CAGR                         : {0:.2f}%".format(stats['cagr'] * 100.0))
+    print("Volatility                   : {0:.2f}%".format(stats['volatility'] * 100.0))
+    print("Sharpe Ratio                 : {0:.2f}".format(stats['sharpe']))
+    print("Sortino Ratio                : {0:.2f}".format(stats['sortino']))
+    print("Max Drawdown                 : {0:.2f}%".format(stats['max_drawdown'] * 100.0))
+    print("Max Daily Drawdown           : {0:.2f}%".format(
+        analytics.get_max_drawdown(equity_curve.Portfolio_Value.values) * 100.0))
+    print("Turnover                     : {0:.2f}".format(stats['turnover']))
+    print("Alpha vs SPY                 : {0:.2f}%".format(stats['alpha'] * 100.0))
+    print("Beta vs SPY                  : {0:.2f}".format(stats['beta']))
+    print("\n\n")
+    print("Finished!")
+
+    # Display Graphs
+    import matplotlib.pyplot as plt
+    data_to_plot = pd.DataFrame(index=dates)
+    data_to_plot['Portfolio_Value'] = history.loc['Portfolio_Value']
+    data_to_plot['SPY'            ] = spy_quotes * START_BALANCE / spy_quotes[0]
+    data_to_plot['Daily_Value'    ] = equity_curve.Portfolio_Value
+    plt.figure()
+    data_to_plot.plot()
+    plt.show()
@@ -0,0 +1,266 @@
+import os
+import numpy as np
+from pandas import DataFrame
+from rebalance_calendar import to_date_strings, to_days
+
+
+class HistoryRecorder(object):
+    """Records the account metrics, positions and trades of a backtest run.
+
+    Metrics are written into a preallocated float64 row per date.  Positions and
+    trades are appended to long-format tables of typed columns that double in
+    capacity when full, so recording costs the same on every date and memory
+    follows the number of rows stored.  Symbols and trade types are stored as
+    integer codes and dates as their position among the recorded dates.  The
+    DataFrames are built once by to_frames(), with 'YYYY_MM_DD' dates.
+
+    The holdings left after trading on each date are kept with the cash balance
+    so the account can be marked to market on the days between rebalances.
+
+    Rows can also be streamed to a HistoryWriter as they are recorded.  With
+    keep=False only the metrics and holdings stay in memory and the positions
+    and trades tables are left to the writer, so a state saved with keep=False
+    reads them back from the files of that writer when it is restored.
+    """
+
+    METRICS = ['Portfolio_Value', 'Cash', 'Long_Value', 'Short_Value', 'Total_Return', 'Long_Return', 'Short_Return']
+    SIDES = ['long', 'short']
+    TRADE_TYPES = ['buy', 'sell', 'short', 'cover']
+
+    POSITION_COLUMNS = [('date_id', np.int32), ('symbol_id', np.int32), ('side', np.int8),
+                        ('qty', np.float64), ('value', np.float64)]
+    TRADE_COLUMNS = [('date_id', np.int32), ('symbol_id', np.int32), ('type', np.int8), ('shares', np.float64),
+                     ('price', np.float64), ('transfer_amt', np.float64), ('commission', np.float64)]
+    HOLDING_COLUMNS = [('date_id', np.int32), ('symbol_id', np.int32), ('qty', np.float64), ('price', np.float64)]
+
+
+    def __init__(self, dates, capacity=64, writer=None, keep=True):
+        '''dates are the dates that will be recorded, in order, as day numbers or dates.
+        capacity is the number of position and trade rows allocated before the first resize.'''
+        assert keep or writer is not None, \
+            "ERROR in HistoryRecorder.__init__() >> positions and trades must be kept without a writer"
+        self.days = to_days(dates)
+        self.dates = to_date_strings(self.days)
+        self._date_ids = dict((day, i) for i, day in enumerate(self.days.tolist()))
+        self.writer = writer
+        self.keep = keep
+        self._metrics = np.full((len(self.dates), len(self.METRICS)), np.nan)
+        self._recorded = 0
+        self._symbols = []
+        self._symbol_ids = {}
+        self._positions = self._allocate(self.POSITION_COLUMNS, capacity)
+        self._position_count = 0
+        self._trades = self._allocate(self.TRADE_COLUMNS, capacity)
+        self._trade_count = 0
+        self._holdings = self._allocate(self.HOLDING_COLUMNS, capacity)
+        self._holding_count = 0
+        self._holding_cash = np.full(len(self.dates), np.nan)
+        return super(HistoryRecorder, self).__init__()
+
+
+    def _allocate(self, columns, capacity):
+        return dict((name, np.zeros(capacity, dtype=dtype)) for name, dtype in columns)
+
+
+    def _reserve(self, table, count, extra):
+        '''Returns table with room for extra more rows, doubling its capacity as needed.'''
+        capacity = len(table['date_id'])
+        if count + extra <= capacity:
+            return table
+        capacity = max(2 * capacity, count + extra)
+        for name, column in table.items():
+            table[name] = np.resize(column, capacity)
+        return table
+
+
+    def _get_date_id(self, date):
+        '''Returns the position of a recorded date.'''
+        date_id = self._date_ids.get(date)
+        if date_id is None:
+            date_id = self._date_ids[int(to_days([date])[0])]
+        return date_id
+
+
+    def _get_symbol_ids(self, symbols):
+        '''Returns the integer codes of symbols, assigning new codes to unseen symbols.'''
+        ids = np.empty(len(symbols), dtype=np.int32)
+        for i, symbol in enumerate(symbols):
+            symbol_id = self._symbol_ids.get(symbol)
+            if symbol_id is None:
+                symbol_id = self._symbol_ids[symbol] = len(self._symbols)
+                self._symbols.append(symbol)
+            ids[i] = symbol_id
+        return ids
+
+
+    def record_metrics(self, date, values):
+        '''Stores the values of METRICS for a date.'''
+        date_id = self._get_date_id(date)
+        self._metrics[date_id] = values
+        self._recorded = max(self._recorded, date_id + 1)
+        if self.writer is not None:
+            self.writer.write_metrics(date, values)
+
+
+    def record_positions(self, date, side, symbols, qty, values):
+        '''Appends one row per position held on a date on side 'long' or 'short'.'''
+        if self.writer is not None:
+            self.writer.write_positions(date, side, symbols, qty, values)
+        if not self.keep:
+            return
+        count = len(symbols)
+        table = self._reserve(self._positions, self._position_count, count)
+        rows = slice(self._position_count, self._position_count + count)
+        table['date_id'][rows] = self._get_date_id(date)
+        table['symbol_id'][rows] = self._get_symbol_ids(symbols)
+        table['side'][rows] = self.SIDES.index(side)
+        table['qty'][rows] = qty
+        table['value'][rows] = values
+        self._position_count += count
+
+
+    def record_trades(self, date, symbols, types, shares, prices, transfer_amts, commissions):
+        '''Appends one row per order placed on a date.'''
+        if self.writer is not None:
+            self.writer.write_trades(date, symbols, types, shares, prices, transfer_amts, commissions)
+        if not self.keep:
+            return
+        count = len(symbols)
+        table = self._reserve(self._trades, self._trade_count, count)
+        rows = slice(self._trade_count, self._trade_count + count)
+        table['date_id'][rows] = self._get_date_id(date)
+        table['symbol_id'][rows] = self._get_symbol_ids(symbols)
+        table['type'][rows] = [self.TRADE_TYPES.index(order_type) for order_type in types]
+        table['shares'][rows] = shares
+        table['price'][rows] = prices
+        table['transfer_amt'][rows] = transfer_amts
+        table['commission'][rows] = commissions
+        self._trade_count += count
+
+
+    def record_holdings(self, date, cash, symbols, qty, prices):
+        '''Stores the cash and the quantity and average price of every position held
+        after trading on a date.'''
+        date_id = self._get_date_id(date)
+        self._holding_cash[date_id] = cash
+        count = len(symbols)
+        table = self._reserve(self._holdings, self._holding_count, count)
+        rows = slice(self._holding_count, self._holding_count + count)
+        table['date_id'][rows] = date_id
+        table['symbol_id'][rows] = self._get_symbol_ids(symbols)
+        table['qty'][rows] = qty
+        table['price'][rows] = prices
+        self._holding_count += count
+
+
+    def get_holdings(self):
+        '''Returns the cash after trading on each recorded date, and for each of those
+        dates an array of symbols held with arrays of their quantities and average prices.'''
+        symbols = np.array(self._symbols, dtype=object)
+        date_ids = self._holdings['date_id'][:self._holding_count]
+        bounds = np.searchsorted(date_ids, np.arange(self._recorded + 1))
+        holdings = [(symbols[self._holdings['symbol_id'][start:end]], self._holdings['qty'][start:end],
+                     self._holdings['price'][start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+        return self._holding_cash[:self._recorded].copy(), holdings
+
+
+    def record_trade(self, date, symbol, order_results):
+        '''Appends the result dict of one order returned by OrderManager.'''
+        self.record_trades(date, [symbol], [order_results['type']], [order_results['shares']],
+                           [order_results['price']], [order_results['transfer_amt']],
+                           [order_results['commission']])
+
+
+    def get_state(self):
+        '''Returns the rows recorded so far as a dict of arrays.'''
+        state = {'metrics'      : self._metrics[:self._recorded].copy(),
+                 'holding_cash' : self._holding_cash[:self._recorded].copy(),
+                 'symbols'      : np.array(self._symbols, dtype=str)}
+        for prefix, table, count in (('positions_', self._positions, self._position_count),
+                                     ('trades_', self._trades, self._trade_count),
+                                     ('holdings_', self._holdings, self._holding_count)):
+            for name, column in table.items():
+                state[prefix + name] = column[:count].copy()
+        if not self.keep:
+            # The positions and trades are only held in the files of the writer
+            state['written_prefix'] = np.array(os.path.abspath(self.writer.path_prefix))
+            state['written_formats'] = np.array(self.writer.formats)
+        return state
+
+
+    def set_state(self, state):
+        '''Restores the rows saved by get_state() and streams them to the writer.  The
+        positions and trades of a state saved with keep=False are read from the files
+        its writer left, which must still be in place.'''
+        self._recorded = len(state['metrics'])
+        self._metrics[:self._recorded] = state['metrics']
+        self._symbols = [str(symbol) for symbol in state['symbols']]
+        self._symbol_ids = dict((symbol, i) for i, symbol in enumerate(self._symbols))
+        self._positions = dict((name, np.array(state['positions_' + name], dtype=dtype))
+                               for name, dtype in self.POSITION_COLUMNS)
+        self._position_count = len(self._positions['date_id'])
+        self._trades = dict((name, np.array(state['trades_' + name], dtype=dtype))
+                            for name, dtype in self.TRADE_COLUMNS)
+        self._trade_count = len(self._trades['date_id'])
+        self._holdings = dict((name, np.array(state['holdings_' + name], dtype=dtype))
+                              for name, dtype in self.HOLDING_COLUMNS)
+        self._holding_count = len(self._holdings['date_id'])
+        self._holding_cash[:self._recorded] = state['holding_cash']
+
+        history, positions, trades = self.to_frames()
+        if 'written_prefix' in state:
+            # Only the files of the writer that recorded the state hold its positions and trades,
+            #   along with any rows the run wrote after saving it
+            from history_writer import read_table
+            positions, trades = [read_table(str(state['written_prefix']), table, list(state['written_formats']))
+                                 for table in ('positions', 'trades')]
+            last = self.dates[self._recorded - 1] if self._recorded else ''
+            positions, trades = positions[positions.date <= last], trades[trades.date <= last]
+            if self.keep:
+                self._positions = self._from_frame(positions, self.POSITION_COLUMNS, {'side': self.SIDES})
+                self._position_count = len(positions)
+                self._trades = self._from_frame(trades, self.TRADE_COLUMNS, {'type': self.TRADE_TYPES})
+                self._trade_count = len(trades)
+
+        if self.writer is not None:
+            self.writer.write('metrics', dict([('date', history.columns.values)] +
+                                              [(metric, history.loc[metric].values) for metric in self.METRICS]))
+            self.writer.write('positions', dict((name, positions[name].values) for name in positions.columns))
+            self.writer.write('trades', dict((name, trades[name].values) for name in trades.columns))
+
+
+    def _from_frame(self, frame, columns, codes):
+        '''Returns a table of the rows of a DataFrame made by _to_frame(), with codes encoded.'''
+        days = to_days(np.asarray(frame['date'].values, dtype=str)).tolist()
+        table = {'date_id'  : np.array([self._date_ids[day] for day in days], dtype=np.int32),
+                 'symbol_id': self._get_symbol_ids(frame['symbol'].values)}
+        for name, dtype in columns[2:]:
+            values = frame[name].values
+            if name in codes:
+                values = [codes[name].index(value) for value in values]
+            table[name] = np.array(values, dtype=dtype)
+        return table
+
+
+    def _to_frame(self, table, count, columns, codes):
+        '''Returns the first count rows of a table as a DataFrame with codes decoded.'''
+        dates = np.array(self.dates, dtype=object)
+        symbols = np.array(self._symbols, dtype=object)
+        data = {'date': dates[table['date_id'][:count]], 'symbol': symbols[table['symbol_id'][:count]]}
+        for name, _ in columns[2:]:
+            data[name] = table[name][:count]
+        for name, labels in codes.items():
+            data[name] = np.array(labels, dtype=object)[data[name]]
+        return DataFrame(data, columns=['date', 'symbol'] + [name for name, _ in columns[2:]])
+
+
+    def to_frames(self):
+        '''Returns the history DataFrame with one row per metric and one column per
+        recorded date, and the long-format positions and trades DataFrames.'''
+        history = DataFrame(self._metrics[:self._recorded].T, index=self.METRICS,
+                            columns=self.dates[:self._recorded])
+        positions = self._to_frame(self._positions, self._position_count, self.POSITION_COLUMNS,
+                                   {'side': self.SIDES})
+        trades = self._to_frame(self._trades, self._trade_count, self.TRADE_COLUMNS,
+                                {'type': self.TRADE_TYPES})
+        return history, positions, trades
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+from pandas import DataFrame, read_csv
+from history_recorder import HistoryRecorder
+from rebalance_calendar import to_date_strings, to_days
+
+
+class HistoryWriter(object):
+    """Streams the metrics, positions and trades of a backtest run to disk.
+
+    Rows are buffered per table and appended to the files whenever a table holds
+    buffer_rows rows, on flush() and on close(), so at most buffer_rows rows per
+    table are held in memory or lost in a crash.  Each table is written as
+    <path_prefix><table>.csv and/or as a columnar folder <path_prefix><table>/
+    holding one raw binary file per column plus a columns.txt file listing each
+    column's name and numpy dtype, which read_columnar() loads without parsing.
+    Dates passed as day numbers are written as 'YYYY_MM_DD' strings, and symbols as
+    bytes of symbol_width, which a longer symbol is rejected for rather than cut.
+    """
+
+    FORMATS = ['csv', 'columnar']
+
+    # Columns and binary dtypes of each table, strings are stored as fixed width bytes
+    #   and symbols as bytes of the symbol_width of the writer
+    TABLES = {
+        'metrics'   : [('date', 'S10')] + [(metric, '<f8') for metric in HistoryRecorder.METRICS],
+        'positions' : [('date', 'S10'), ('symbol', 'S16'), ('side', 'S5'), ('qty', '<f8'), ('value', '<f8')],
+        'trades'    : [('date', 'S10'), ('symbol', 'S16'), ('type', 'S5'), ('shares', '<f8'), ('price', '<f8'),
+                       ('transfer_amt', '<f8'), ('commission', '<f8')]
+        }
+
+
+    def __init__(self, path_prefix, formats=FORMATS, buffer_rows=1024, symbol_width=16):
+        '''Pass the length of the longest symbol traded as symbol_width, e.g. that of
+        QuoteManager.get_symbols().'''
+        for format in formats:
+            assert format in self.FORMATS, \
+                "ERROR in HistoryWriter.__init__() >> %s is not in %s" % (format, self.FORMATS)
+        self.path_prefix = path_prefix
+        self.formats = list(formats)
+        self.buffer_rows = buffer_rows
+        self.tables = dict((table, [(name, 'S%d' % symbol_width if name == 'symbol' else dtype)
+                                    for name, dtype in columns])
+                           for table, columns in self.TABLES.items())
+        self._buffers = dict((table, []) for table in self.tables)
+        self._buffered = dict((table, 0) for table in self.tables)
+
+        # Start every table empty with its header or column list written
+        for table, columns in self.tables.items():
+            if 'csv' in self.formats:
+                with open(self._get_csv_path(table), 'w') as f:
+                    f.write(','.join(name for name, _ in columns) + '\n')
+            if 'columnar' in self.formats:
+                folder = self._get_columnar_path(table)
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+                with open(os.path.join(folder, 'columns.txt'), 'w') as f:
+                    f.write('\n'.join('%s %s' % column for column in columns))
+                for name, _ in columns:
+                    open(os.path.join(folder, name + '.bin'), 'wb').close()
+        return super(HistoryWriter, self).__init__()
+
+
+    def _get_csv_path(self, table):
+        return self.path_prefix + table + '.csv'
+
+
+    def _get_columnar_path(self, table):
+        return self.path_prefix + table
+
+
+    def write(self, table, columns):
+        '''Buffers rows given as a dict of equal length columns, flushing the table when
+        buffer_rows rows are waiting.'''
+        count = len(columns[self.tables[table][0][0]])
+        if count == 0:
+            return
+        self._buffers[table].append(columns)
+        self._buffered[table] += count
+        if self._buffered[table] >= self.buffer_rows:
+            self._flush_table(table)
+
+
+    def write_metrics(self, date, values):
+        date = to_date_strings(to_days([date]))[0]
+        names = [name for name, _ in self.tables['metrics']]
+        self.write('metrics', dict(zip(names, [[date]] + [[value] for value in values])))
+
+
+    def write_positions(self, date, side, symbols, qty, values):
+        date = to_date_strings(to_days([date]))[0]
+        self.write('positions', {'date': [date] * len(symbols), 'symbol': symbols, 'side': [side] * len(symbols),
+                                 'qty': qty, 'value': values})
+
+
+    def write_trades(self, date, symbols, types, shares, prices, transfer_amts, commissions):
+        date = to_date_strings(to_days([date]))[0]
+        self.write('trades', {'date': [date] * len(symbols), 'symbol': symbols, 'type': types, 'shares': shares,
+                              'price': prices, 'transfer_amt': transfer_amts, 'commission': commissions})
+
+
+    def _flush_table(self, table):
+        '''Appends the buffered rows of a table to its files and empties the buffer.'''
+        if not self._buffers[table]:
+            return
+        columns = self.tables[table]
+        data = dict((name, np.concatenate([np.asarray(chunk[name]) for chunk in self._buffers[table]]))
+                    for name, _ in columns)
+        if 'csv' in self.formats:
+            frame = DataFrame(data, columns=[name for name, _ in columns])
+            frame.to_csv(self._get_csv_path(table), mode='a', header=False, index=False)
+        if 'columnar' in self.formats:
+            folder = self._get_columnar_path(table)
+            for name, dtype in columns:
+                if np.dtype(dtype).kind == 'S' and len(data[name]):
+                    width = np.char.str_len(data[name].astype(str)).max()
+                    assert width <= np.dtype(dtype).itemsize, \
+                        "ERROR in HistoryWriter._flush_table() >> a %s value of %s characters " % (name, width) + \
+                        "is longer than its %s column, pass a larger symbol_width" % dtype
+            for name, dtype in columns:
+                with open(os.path.join(folder, name + '.bin'), 'ab') as f:
+                    data[name].astype(dtype).tofile(f)
+        self._buffers[table] = []
+        self._buffered[table] = 0
+
+
+    def flush(self):
+        '''Writes every buffered row to disk.'''
+        for table in self.tables:
+            self._flush_table(table)
+
+
+    def close(self):
+        self.flush()
+
+
+def read_columnar(path):
+    '''Returns a DataFrame of a columnar table folder written by HistoryWriter.'''
+    with open(os.path.join(path, 'columns.txt'), 'r') as f:
+        columns = [line.split() for line in f.read().splitlines() if line]
+    data = dict((name, np.fromfile(os.path.join(path, name + '.bin'), dtype=np.dtype(dtype)))
+                for name, dtype in columns)
+
+    # Drop a partly written last row left by a crash during a flush
+    count = min(len(column) for column in data.values())
+    for name in data:
+        data[name] = data[name][:count]
+        if data[name].dtype.kind == 'S':
+            data[name] = data[name].astype(str).astype(object)
+    return DataFrame(data, columns=[name for name, _ in columns])
+
+
+def read_table(path_prefix, table, formats=HistoryWriter.FORMATS):
+    '''Returns a DataFrame of a table written by a HistoryWriter with path_prefix and
+    formats, read from its columnar folder when it was written as one.'''
+    path = path_prefix + table if 'columnar' in formats else path_prefix + table + '.csv'
+    assert os.path.exists(path), "ERROR in read_table() >> the %s table written to %s is missing" % (table, path)
+    if 'columnar' in formats:
+        return read_columnar(path)
+    return read_csv(path, dtype={'date': str, 'symbol': str}, float_precision='round_trip')
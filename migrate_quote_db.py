@@ -0,0 +1,18 @@
+import os
+import quote_db
+
+# File Paths
+DB_FILEPATH     = 'data/daily_gold.db'
+BACKUP_PATH     = 'data/daily_gold_tables.db'   # Where the database with one table per symbol is kept
+
+
+# Rebuild the quote database with one table per symbol into the normalized quotes and symbols tables
+if __name__ == '__main__':
+    tmp_path = DB_FILEPATH + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    symbol_count, quote_count = quote_db.migrate(DB_FILEPATH, tmp_path)
+    os.rename(DB_FILEPATH, BACKUP_PATH)
+    os.rename(tmp_path, DB_FILEPATH)
+    print("Migrated %s quotes of %s symbols into %s, the old database is kept as %s" %
+          (quote_count, symbol_count, DB_FILEPATH, BACKUP_PATH))
@@ -1,6 +1,14 @@
+import math
+from collections import OrderedDict
+import numpy as np
+
+
 class OrderManager(object):
     """Handles the buying and selling of stock"""
 
+    # Columns of the orders returned by rebalance_to()
+    ORDER_COLUMNS = ['symbol', 'type', 'shares', 'price', 'transfer_amt', 'commission']
+
     def __init__(self, 
                  quote_manager,
                  account,
@@ -18,12 +26,27 @@ class OrderManager(object):
         return super(OrderManager, self).__init__()
 
 
+    def get_state(self):
+        '''Returns the order settings as a dict.'''
+        return {'slippage'      : self.slippage,
+                'commission_min': self.commission_min,
+                'commission'    : self.commission,
+                'commission_max': self.commission_max
+                }
+
+
+    def set_state(self, state):
+        '''Restores the order settings saved by get_state().'''
+        for name in ('slippage', 'commission_min', 'commission', 'commission_max'):
+            setattr(self, name, float(state[name]))
+
+
     def cover(self, amount, symbol, date):
         return self._post_order(symbol, date, 'cover', order_amt=amount)
 
 
     def cover_all(self, symbol, date):
-        order_qty = abs(self.account.get_positions().loc[symbol].qty)
+        order_qty = abs(self.account.get_qty(symbol))
         return self._post_order(symbol, date, 'cover', order_qty=order_qty)
 
 
@@ -36,7 +59,7 @@ class OrderManager(object):
 
 
     def sell_all(self, symbol, date):
-        order_qty = abs(self.account.get_positions().loc[symbol].qty)
+        order_qty = abs(self.account.get_qty(symbol))
         return self._post_order(symbol, date, 'sell', order_qty=order_qty)
 
 
@@ -44,6 +67,96 @@ class OrderManager(object):
         return self._post_order(symbol, date, 'buy', order_amt=amount)
 
 
+    def rebalance_to(self, target_weights, date):
+        '''Trades every position toward its target weight, a signed fraction of account
+        value that is positive for long and negative for short positions, in one batch.
+        target_weights may be a dict, Series or list of (symbol, weight) pairs, naming
+        stock by symbol or symbol id, and stock held but missing from it is closed.
+        Sells and covers settle first so their cash funds the buys and then the shorts,
+        each placed in the order of target_weights until the cash runs out.  Returns a
+        dict of equal length arrays of the orders placed, keyed by ORDER_COLUMNS.'''
+        target_weights = OrderedDict(target_weights)
+        positions = self.account.get_positions()
+        target_ids = self._quote_manager.get_symbol_ids(np.array(list(target_weights)))
+        held = np.flatnonzero(positions.qty)
+        ids = np.concatenate([target_ids, held[~np.in1d(held, target_ids)]])
+        weights = np.array(list(target_weights.values()) + [0.] * (len(ids) - len(target_ids)), dtype=float)
+        symbols = positions.index[ids]
+
+        # Gather holdings and quotes, leaving stock without a quote on date untouched
+        qty = positions.qty[ids]
+        avg_price = positions.price[ids]
+        current_price = self._quote_manager.get_quotes(ids, date).astype(float)
+        account_value = self.account.get_account_value(date)
+        assert not np.isnan(account_value), \
+            "ERROR in OrderManager.rebalance_to() >> the account value on %s is NaN, a stock held has no quote" % date
+        with np.errstate(invalid='ignore', divide='ignore'):
+            target_qty = np.trunc(weights * account_value / (current_price + self.slippage * np.sign(weights)))
+        target_qty = np.where(np.isnan(current_price), qty, target_qty)
+
+        # Split each change into the part closing the position and the part opening one
+        long_qty, short_qty = np.maximum(qty, 0), np.maximum(-qty, 0)
+        long_target, short_target = np.maximum(target_qty, 0), np.maximum(-target_qty, 0)
+        orders = [('sell',  long_qty - long_target,   -1, -1),
+                  ('cover', short_qty - short_target,  1, -1),
+                  ('buy',   long_target - long_qty,    1,  1),
+                  ('short', short_target - short_qty, -1, -1)]
+
+        # Lay the orders out in settlement order with their slippage and per share value
+        placed = [np.flatnonzero(shares > 0) for _, shares, _, _ in orders]
+        rows = np.concatenate(placed)
+        order_types = np.repeat([order[0] for order in orders], [len(p) for p in placed])
+        shares = np.concatenate([orders[i][1][p] for i, p in enumerate(placed)]).astype(int)
+        multiplier = np.repeat([order[2] for order in orders], [len(p) for p in placed])
+        fee_multiplier = np.repeat([order[3] for order in orders], [len(p) for p in placed])
+        price = current_price[rows] + self.slippage * multiplier
+        # A cover returns what the short has gained on its average price, less slippage
+        unit_value = np.where(order_types == 'cover', 2 * avg_price[rows] - current_price[rows] - self.slippage, price)
+        commission = self._get_commissions(shares, price)
+        transfer_amt = shares * unit_value + commission * fee_multiplier
+        closing = len(placed[0]) + len(placed[1])
+
+        # Fit the buys and shorts into the cash available after the sells and covers
+        available = self.account.get_cash_value() + transfer_amt[:closing].sum()
+        spent = np.cumsum(transfer_amt[closing:])
+        fits = np.concatenate([np.ones(closing, dtype=bool), spent <= available])
+        if not fits.all():
+            first = np.argmin(fits)
+            remaining = available - (spent[first - closing - 1] if first > closing else 0.)
+            shares[first] = self._get_max_qty(shares[first], unit_value[first], price[first],
+                                              fee_multiplier[first], remaining)
+            commission[first] = self._get_commission(shares[first], price[first])
+            transfer_amt[first] = self._get_transfer_amt(shares[first], unit_value[first], price[first],
+                                                         fee_multiplier[first])
+            fits[first] = shares[first] > 0
+
+        # Settle the closing orders, then the opening orders
+        for batch in (np.arange(closing), np.flatnonzero(fits[closing:]) + closing):
+            if len(batch) == 0:
+                continue
+            if batch[0] < closing:
+                self.account.deposit_cash(transfer_amt[batch].sum())
+            else:
+                succeeded = self.account.withdraw_cash(transfer_amt[batch].sum())
+                assert succeeded, 'ERROR in OrderManager.rebalance_to() >> not enough cash for opening orders'
+            self.account.apply_trades(ids[rows[batch]], shares[batch] * multiplier[batch], price[batch])
+
+        return {'symbol'        : symbols[rows[fits]],
+                'type'          : order_types[fits],
+                'shares'        : shares[fits],
+                'price'         : price[fits],
+                'transfer_amt'  : transfer_amt[fits],
+                'commission'    : commission[fits]
+                }
+
+
+    def _get_commissions(self, order_qty, price):
+        '''Returns the commission on each of an array of orders, see _get_commission().'''
+        commission_total = np.maximum(self.commission * order_qty, self.commission_min)
+        capped = np.minimum(commission_total, self.commission_max * order_qty * price)
+        return np.where(commission_total > self.commission_min, capped, commission_total)
+
+
     def _post_order(self, symbol, date, order_type, order_qty=None, order_amt=None):
 
         # Determine account changes based on order type
@@ -72,40 +185,36 @@ class OrderManager(object):
 
         price = self._quote_manager.get_quote(symbol, date) + self.slippage * multiplier
 
+        # A cover returns its share of the short position's value less slippage, other orders move shares at price
+        if order_type == 'cover':
+            qty_owned = abs(self.account.get_qty(symbol))
+            unit_value = self.account.get_position_value(symbol, date) / qty_owned - self.slippage
+        else:
+            unit_value = price
+
+        # Never sell or cover more shares than are owned
         if order_amt != None:
             order_qty = int(order_amt / price)
-        
-        succeeded = False
-        while not succeeded:
-            shares_value = order_qty * price
-            commission_total = max((self.commission * order_qty), self.commission_min)
-            if commission_total > self.commission_min:
-                commission_total = min(commission_total, self.commission_max * shares_value)
-                
-            if order_type == 'cover':
-                cover_slip = order_qty * self.slippage
-                transfer_amt = (cover_slip + commission_total) * fee_multiplier + self.account.get_position_value(symbol, date)
-            else:
-                transfer_amt = commission_total * fee_multiplier + shares_value
+            if order_type in ('sell', 'cover'):
+                order_qty = min(order_qty, int(abs(self.account.get_qty(symbol))))
 
-            # If the fees and slippage are too much reduce order quantity and recalculate
-            if order_amt != None and transfer_amt > order_amt:
-                order_qty -= 1
-                continue
-                if order_qty <= 0:
-                    transfer_amt = 0
-                    break
+        # The transfer can't exceed the order amount, nor the cash available when cash is withdrawn
+        budget = float('inf') if order_amt == None else order_amt
+        if order_type in ('buy', 'short'):
+            budget = min(budget, self.account.get_cash_value())
 
+        order_qty = self._get_max_qty(order_qty, unit_value, price, fee_multiplier, budget)
+        commission_total = self._get_commission(order_qty, price)
+        if order_qty <= 0:
+            transfer_amt = 0
+        else:
+            transfer_amt = self._get_transfer_amt(order_qty, unit_value, price, fee_multiplier)
             succeeded = cash_func(transfer_amt)
+            assert succeeded, \
+                'ERROR in OrderManager._post_order() >> transfer of %s for %s failed' % (transfer_amt, symbol)
 
-            if succeeded:
-                # TODO: consider adding commission to average price per share
-                stock_func(symbol, order_qty * multiplier, price)
-            else:
-                order_qty -= 1
-                if order_qty <= 0: 
-                    transfer_amt = 0
-                    break
+            # TODO: consider adding commission to average price per share
+            stock_func(symbol, order_qty * multiplier, price)
 
         return {'shares'        : order_qty, 
                 'price'         : price, 
@@ -115,6 +224,53 @@ class OrderManager(object):
                 }
 
 
+    def _get_commission(self, order_qty, price):
+        '''Returns the commission on order_qty shares: a per share cost that is at least
+        commission_min, and above it at most commission_max of the value traded.'''
+        commission_total = max((self.commission * order_qty), self.commission_min)
+        if commission_total > self.commission_min:
+            commission_total = min(commission_total, self.commission_max * order_qty * price)
+        return commission_total
+
+
+    def _get_transfer_amt(self, order_qty, unit_value, price, fee_multiplier):
+        '''Returns the cash moved by an order of order_qty shares worth unit_value each.'''
+        return order_qty * unit_value + self._get_commission(order_qty, price) * fee_multiplier
+
+
+    def _get_max_qty(self, max_qty, unit_value, price, fee_multiplier, budget):
+        '''Returns the largest quantity up to max_qty whose transfer amount fits in budget.'''
+        if budget == float('inf') or max_qty <= 0:
+            return max(int(max_qty), 0)
+
+        # Quantities up to min_tier_qty pay commission_min, larger ones pay a rate per share
+        if self.commission > 0:
+            min_tier_qty = int(self.commission_min / self.commission)
+        else:
+            min_tier_qty = max_qty
+
+        # Solve the transfer amount of each commission tier for the quantity
+        order_qty = 0
+        if unit_value > 0:
+            order_qty = min(max_qty, min_tier_qty,
+                            math.floor((budget - fee_multiplier * self.commission_min) / unit_value))
+        if max_qty > min_tier_qty:
+            rate = unit_value + fee_multiplier * min(self.commission, self.commission_max * price)
+            tier_qty = max_qty if rate <= 0 else min(max_qty, math.floor(budget / rate))
+            if tier_qty > min_tier_qty:
+                order_qty = max(order_qty, tier_qty)
+        order_qty = max(int(order_qty), 0)
+
+        # Correct any rounding in the division above
+        while order_qty > 0 and \
+              self._get_transfer_amt(order_qty, unit_value, price, fee_multiplier) > budget:
+            order_qty -= 1
+        while order_qty < max_qty and \
+              self._get_transfer_amt(order_qty + 1, unit_value, price, fee_multiplier) <= budget:
+            order_qty += 1
+        return order_qty
+
+
 # Used for debugging and development
 if __name__ == '__main__':
     from account_manager import AccountManager
@@ -0,0 +1,102 @@
+import sqlite3 as lite
+import numpy as np
+from rebalance_calendar import to_date_strings, to_days
+
+
+# The normalized daily quote database holds every quote in one table clustered on
+#   (day, symbol_id), so all the quotes of a day are stored together, and a second
+#   index on (symbol_id, day) serves the history of one symbol.  day counts the days
+#   since 1970-01-01 and symbol_id refers to the symbols table.
+SCHEMA = ["CREATE TABLE IF NOT EXISTS symbols (symbol_id INTEGER PRIMARY KEY, symbol TEXT NOT NULL UNIQUE)",
+          "CREATE TABLE IF NOT EXISTS quotes (symbol_id INTEGER NOT NULL, day INTEGER NOT NULL, "
+          "open REAL, high REAL, low REAL, close REAL, volume INTEGER, adj_close REAL, "
+          "PRIMARY KEY (day, symbol_id)) WITHOUT ROWID",
+          "CREATE INDEX IF NOT EXISTS quotes_symbol_day ON quotes (symbol_id, day)"]
+
+# Columns of the quotes table holding each QuoteManager quote type
+QUOTE_COLUMNS = [('Open', 'open'), ('Close', 'close'), ('High', 'high'), ('Low', 'low'),
+                 ('Volume', 'volume'), ('Adj_Close', 'adj_close')]
+
+# Check whether a database holds the normalized quotes and symbols tables
+def is_normalized(con):
+    tables = set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    return 'quotes' in tables and 'symbols' in tables
+
+
+def create_schema(con):
+    for statement in SCHEMA:
+        con.execute(statement)
+
+
+# Get the symbols of a normalized database by symbol_id
+def read_symbols(con):
+    return dict((int(symbol_id), str(symbol))
+                for symbol_id, symbol in con.execute("SELECT symbol_id, symbol FROM symbols"))
+
+
+def get_symbol_id(con, symbol):
+    '''Returns the symbol_id of a symbol, adding it to the symbols table if it is new.'''
+    row = con.execute("SELECT symbol_id FROM symbols WHERE symbol = ?", (symbol,)).fetchone()
+    if row is not None:
+        return row[0]
+    return con.execute("INSERT INTO symbols (symbol) VALUES (?)", (symbol,)).lastrowid
+
+
+# Count the quotes of every symbol in either the normalized or the one table per symbol layout
+def get_row_counts(con):
+    if is_normalized(con):
+        names = read_symbols(con)
+        return dict((names[symbol_id], count) for symbol_id, count in
+                    con.execute("SELECT symbol_id, COUNT(*) FROM quotes GROUP BY symbol_id"))
+    tables = [str(row[0]) for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    return dict((table, con.execute("SELECT COUNT(*) FROM [%s]" % table).fetchone()[0]) for table in tables)
+
+
+def read_cross_section(con, date, column='adj_close'):
+    '''Returns the symbols quoted on a date and an array of their values in column.'''
+    rows = con.execute("SELECT symbols.symbol, quotes.%s FROM quotes JOIN symbols USING (symbol_id) "
+                       "WHERE quotes.day = ? ORDER BY symbols.symbol" % column, (int(to_days([date])[0]),)).fetchall()
+    return [str(row[0]) for row in rows], np.array([row[1] for row in rows], dtype=np.float64)
+
+
+def read_last_days(con):
+    '''Returns a dict of the last quoted date of every symbol.'''
+    names = read_symbols(con)
+    rows = con.execute("SELECT symbol_id, MAX(day) FROM quotes GROUP BY symbol_id").fetchall()
+    dates = to_date_strings([row[1] for row in rows])
+    return dict((names[row[0]], date) for row, date in zip(rows, dates))
+
+
+def migrate(src_path, dst_path, chunk_rows=500000):
+    '''Copies the daily quotes of a database with one table per symbol into a new
+    normalized database at dst_path.  Where a table holds one date twice the last
+    row is kept.  Returns the number of symbols and quotes written.'''
+    src = lite.connect(src_path)
+    tables = sorted(str(row[0]) for row in src.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    dst = lite.connect(dst_path, isolation_level=None)
+    dst.execute("PRAGMA journal_mode=WAL")
+    dst.execute("PRAGMA synchronous=NORMAL")
+    create_schema(dst)
+
+    pending = 0
+    for table in tables:
+        rows = src.execute("SELECT Datetime, Open, High, Low, Close, Volume, Adj_Close FROM [%s]" % table).fetchall()
+        dates = [str(row[0]) for row in rows]
+        assert all(len(date) == 10 for date in dates), \
+            "ERROR in migrate() >> table %s holds intraday quotes, only daily quotes can be migrated" % table
+        if pending == 0:
+            dst.execute("BEGIN")
+        symbol_id = get_symbol_id(dst, table)
+        dst.executemany("INSERT OR REPLACE INTO quotes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(symbol_id, day) + tuple(row[1:]) for day, row in zip(to_days(dates).tolist(), rows)])
+        pending += len(rows) + 1
+        if pending >= chunk_rows:
+            dst.execute("COMMIT")
+            pending = 0
+    if pending > 0:
+        dst.execute("COMMIT")
+    quote_count = dst.execute("SELECT COUNT(*) FROM quotes").fetchone()[0]
+    dst.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    dst.close()
+    src.close()
+    return len(tables), quote_count
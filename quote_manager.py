@@ -1,53 +1,592 @@
+import hashlib
+import numbers
+import os
+import shutil
 import sqlite3 as lite
+import numpy as np
+import quote_db
+from collections import OrderedDict
 from pandas import DataFrame, read_sql_query
+from rebalance_calendar import get_exchange_days, to_date_strings, to_days
 
 
 class QuoteManager(object):
-    """Interacts with database of stock prices."""
+    """Interacts with database of stock prices.
+
+    Quotes are held in a dense panel: one (dates x symbols) array per quote type,
+    addressed by integer date and symbol ids so batches of prices can be gathered
+    with a single array lookup.  Dates may be passed as 'YYYY_MM_DD' strings or as
+    the int32 day numbers of rebalance_calendar.to_days(), which are looked up
+    without any string handling, and symbols as names or symbol ids.  Missing bars
+    are stored as NaN, and a boolean (dates x symbols) mask of the available
+    Adj_Close quotes is built at load time.
+
+    The database may hold the normalized quotes and symbols tables of quote_db, which
+    are read with one range query, or the older layout of one table per symbol.
+
+    The dates of the panel are those quoted in the database unless a master calendar
+    is passed, and dates without a bar may be filled at load time by a fill policy,
+    so a lookup never has to search for an earlier quote.  The availability mask only
+    marks real bars.
+    """
 
     QUOTE_TYPES = ['Open', 'Close', 'High', 'Low', 'Volume', 'Adj_Close']
 
+    # None leaves dates without a bar NaN, 'ffill' repeats the last bar and 'asof' sets
+    #   the prices to the last close with no volume
+    FILL_POLICIES = [None, 'ffill', 'asof']
+
+    # Symbols whose quote data is known to be bad and is never returned
+    UNAVAILABLE_SYMBOLS = ['ANVGQ']
+
+
+    def __init__(self, db_path, dtype=np.float64, start_date=None, end_date=None,
+                 lazy=False, max_memory_mb=None, calendar_symbol='SPY', cache_path=None,
+                 calendar=None, fill=None, fill_limit=None):
+        '''Pass dtype=np.float32 to halve the memory used by the panel.  Note that
+        float32 only holds integers exactly up to 2**24, so large volumes are rounded.
 
-    def __init__(self, db_path):
+        Only quotes dated between start_date and end_date ('YYYY_MM_DD', inclusive)
+        are read.  With lazy=True a symbol is read on first access into a pool of
+        panel columns capped at max_memory_mb, evicting the least recently used
+        symbol when the pool is full.  A single lookup of more symbols than the pool
+        holds widens it to fit them, past max_memory_mb.  The dates of a lazy panel
+        are taken from the calendar_symbol table, and with one table per symbol the
+        dates each symbol has quotes on are only read once the symbol is first used.
+
+        If cache_path is set, the built panel is saved there as a quote store keyed
+        by a fingerprint of the database and the arguments above, and later runs map
+        that snapshot instead of reading the database until any table changes.
+
+        calendar aligns the panel onto a master list of dates, or onto the exchange
+        days of rebalance_calendar.get_exchange_days() between the first and last
+        quote with calendar='exchange'.  Bars on other dates are dropped.  fill is one
+        of FILL_POLICIES, filling dates without a bar from the last bar up to
+        fill_limit dates before them, or any date before them if None.'''
+        assert fill in self.FILL_POLICIES, \
+            "ERROR in QuoteManager.__init__() >> fill must be one of %s, not %s" % (self.FILL_POLICIES, fill)
         self.db_path = db_path
         self.con = lite.connect(self.db_path)
-        self._quotes = {}
+        self.dtype = np.dtype(dtype)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.lazy = lazy
+        self.calendar = calendar
+        self.fill = fill
+        self.fill_limit = fill_limit
 
-        # Connect to quotes database and load all quotes into memory
-        # TODO: If using files larger than 10mb, consider modifying to optimize memory usage
+        # Connect to quotes database and list its tables
         with self.con:
             cur = self.con.cursor()
             cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
             tables = cur.fetchall()
-            for table in tables:
-                df = read_sql_query("SELECT * from [%s]" % table[0], self.con)
-                self._quotes[str(table[0])] = df.set_index('Datetime')
-                pass
-        print("QuoteManager has the database %s loaded into memory..." % db_path)
+        self._normalized = quote_db.is_normalized(self.con)
+        if self._normalized:
+            self._db_ids = dict((symbol, symbol_id) for symbol_id, symbol in quote_db.read_symbols(self.con).items())
+            symbols = sorted(self._db_ids)
+        else:
+            symbols = sorted(str(table[0]) for table in tables)
+
+        # Map a snapshot of the panel if one was saved from the database as it is now
+        snapshot_path = None
+        if cache_path is not None and not lazy:
+            db_stamp = self._get_db_stamp(symbols)
+            snapshot_path = os.path.join(cache_path, '%s_%s' % (os.path.basename(db_path),
+                                                                self._get_fingerprint(db_stamp)))
+            if os.path.exists(snapshot_path):
+                self._open_store(snapshot_path)
+                print("QuoteManager has the cached snapshot of %s mapped into memory..." % db_path)
+                return super(QuoteManager, self).__init__()
+
+        # Build the date axis of the panel, reading every table unless lazy
+        if lazy:
+            dates = self._read_table(calendar_symbol).index
+            bytes_per_symbol = max(1, len(dates) * len(self.QUOTE_TYPES) * self.dtype.itemsize)
+            if max_memory_mb is None:
+                capacity = len(symbols)
+            else:
+                capacity = int(max_memory_mb * 2**20 // bytes_per_symbol)
+                capacity = max(1, min(capacity, len(symbols)))
+        elif self._normalized:
+            quotes = self._read_quotes()
+            dates = np.unique(quotes['day'].values)
+            capacity = len(symbols)
+        else:
+            frames = dict((symbol, self._read_table(symbol)) for symbol in symbols)
+            dates = set()
+            for df in frames.values():
+                dates.update(df.index)
+            capacity = len(symbols)
+        dates = to_days(sorted(dates))
+        if calendar is not None:
+            dates = self._get_calendar(calendar, dates)
+        self._set_axes(symbols, dates)
+
+        # Allocate the panel columns and the symbol to column mapping
+        shape = (len(self._dates), capacity)
+        self._panel = dict((type, np.full(shape, np.nan, dtype=self.dtype)) for type in self.QUOTE_TYPES)
+        self._slots = np.full(len(self._symbols), -1, dtype=np.intp)
+        self._lru = OrderedDict()
+
+        if lazy:
+            self._available = np.zeros((len(self._dates), len(self._symbols)), dtype=bool)
+            if self._normalized:
+                # One query over the quotes table finds the available quotes of every symbol
+                quotes = self._read_quotes(["adj_close IS NOT NULL"], columns=[])
+                rows, cols, found = self._get_cells(quotes)
+                self._available[rows[found], cols[found]] = True
+            else:
+                # The dates of each table are read when the symbol is first used
+                self._has_available[:] = False
+            print("QuoteManager will load quotes from %s on demand..." % db_path)
+        else:
+            if self._normalized:
+                rows, cols, found = self._get_cells(quotes)
+                for type, column in quote_db.QUOTE_COLUMNS:
+                    self._panel[type][rows[found], cols[found]] = quotes[column].values[found]
+            else:
+                for symbol, df in frames.items():
+                    self._store(self._symbol_ids[symbol], df, self._symbol_ids[symbol])
+            self._available = ~np.isnan(self._panel['Adj_Close'])
+            self._fill(slice(None))
+            print("QuoteManager has the database %s loaded into memory..." % db_path)
+
+            # Save a snapshot for later runs and remove those of older versions of the database
+            if snapshot_path is not None:
+                self._evict_snapshots(cache_path, db_stamp)
+                self.save_store(snapshot_path)
+                with open(os.path.join(snapshot_path, 'db_stamp.txt'), 'w') as f:
+                    f.write('\n'.join(db_stamp))
         return super(QuoteManager, self).__init__()
 
 
-    def get_quote(self, symbol, date, type='Adj_Close'):
-        # Assert that the quote type passed is valid
+    @classmethod
+    def from_store(cls, store_path, mmap_mode='r'):
+        '''Opens a quote store written by save_store().  The panel arrays are memory
+        mapped, so processes opening the same store share the OS page cache.'''
+        qm = cls.__new__(cls)
+        qm.db_path = store_path
+        qm.con = None
+        qm.start_date = None
+        qm.end_date = None
+        qm.lazy = False
+        qm.calendar = None
+        qm.fill = None
+        qm.fill_limit = None
+        qm._open_store(store_path, mmap_mode)
+        print("QuoteManager has the quote store %s mapped into memory..." % store_path)
+        return qm
+
+
+    def _open_store(self, store_path, mmap_mode='r'):
+        '''Reads the index files of a quote store then maps one array per quote type.'''
+        with open(os.path.join(store_path, 'symbols.txt'), 'r') as f:
+            symbols = f.read().split()
+        with open(os.path.join(store_path, 'dates.txt'), 'r') as f:
+            dates = f.read().split()
+        self._set_axes(symbols, dates)
+        self._panel = dict((type, np.load(os.path.join(store_path, type + '.npy'), mmap_mode=mmap_mode))
+                           for type in self.QUOTE_TYPES)
+        self.dtype = self._panel['Adj_Close'].dtype
+        available_path = os.path.join(store_path, 'available.npy')
+        if os.path.exists(available_path):
+            self._available = np.load(available_path, mmap_mode=mmap_mode)
+        else:
+            self._available = ~np.isnan(self._panel['Adj_Close'])
+        self._slots = np.arange(len(symbols), dtype=np.intp)
+        self._lru = OrderedDict()
+
+
+    def _get_db_stamp(self, symbols):
+        '''Returns the absolute path of the database and a hash of its modified time, size
+        and per-table row counts, which changes whenever the database does.'''
+        stat = os.stat(self.db_path)
+        counts = quote_db.get_row_counts(self.con)
+        counts = [counts.get(symbol, 0) for symbol in symbols]
+        key = repr((stat.st_mtime, stat.st_size, list(zip(symbols, counts))))
+        return os.path.abspath(self.db_path), hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+    def _evict_snapshots(self, cache_path, db_stamp):
+        '''Removes the snapshots of the database saved before its last change.  Snapshots
+        of other windows or settings of the current database are kept.'''
+        if not os.path.exists(cache_path):
+            return
+        db_path, stamp = db_stamp
+        prefix = os.path.basename(db_path) + '_'
+        for name in os.listdir(cache_path):
+            stamp_path = os.path.join(cache_path, name, 'db_stamp.txt')
+            if not name.startswith(prefix) or not os.path.exists(stamp_path):
+                continue
+            with open(stamp_path, 'r') as f:
+                saved_path, saved_stamp = f.read().split('\n')
+            if saved_path == db_path and saved_stamp != stamp:
+                # A snapshot still mapped by another process can't be removed on Windows
+                shutil.rmtree(os.path.join(cache_path, name), ignore_errors=True)
+
+
+    def _get_fingerprint(self, db_stamp):
+        '''Returns a hash of the database stamp of _get_db_stamp() along with the
+        arguments that shape the panel.'''
+        # repr() abbreviates long arrays, so a master calendar is keyed by the hash of its days
+        calendar = self.calendar
+        if calendar is not None and not isinstance(calendar, basestring):
+            calendar = hashlib.sha1(to_days(calendar).tobytes()).hexdigest()
+        key = repr(db_stamp + (self.start_date, self.end_date, self.dtype.str, self.UNAVAILABLE_SYMBOLS,
+                               calendar, self.fill, self.fill_limit))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+    def save_store(self, store_path):
+        '''Writes the panel to store_path as one .npy array per quote type, the
+        availability mask as available.npy, and symbols.txt and dates.txt index
+        files, replacing any existing store.'''
+        assert not self.lazy, \
+            "ERROR in QuoteManager.save_store() >> a lazy QuoteManager does not hold every symbol"
+
+        # Write into a temporary folder and swap it in so readers never see a partial store
+        tmp_path = store_path.rstrip('/\\') + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for type in self.QUOTE_TYPES:
+            np.save(os.path.join(tmp_path, type + '.npy'), np.ascontiguousarray(self._panel[type]))
+        np.save(os.path.join(tmp_path, 'available.npy'), np.ascontiguousarray(self._available))
+        with open(os.path.join(tmp_path, 'symbols.txt'), 'w') as f:
+            f.write('\n'.join(self._symbols))
+        with open(os.path.join(tmp_path, 'dates.txt'), 'w') as f:
+            f.write('\n'.join(self._dates))
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+        os.rename(tmp_path, store_path)
+
+
+    def __getstate__(self):
+        # The sqlite connection can't be pickled, and only a lazy panel reads from it after loading
+        state = self.__dict__.copy()
+        state['con'] = None
+        return state
+
+
+    def _set_axes(self, symbols, dates):
+        '''Sets the symbol and sorted date axes of the panel and their id lookups.'''
+        self._symbols = list(symbols)
+        self._symbol_ids = dict((symbol, i) for i, symbol in enumerate(self._symbols))
+        self._days = to_days(dates)
+        self._dates = to_date_strings(self._days)
+        self._date_ids = dict((day, i) for i, day in enumerate(self._days.tolist()))
+        self._has_available = np.ones(len(self._symbols), dtype=bool)
+        self._last_bars = None
+        self._has_last_bars = np.zeros(len(self._symbols), dtype=bool)
+
+
+    def _get_calendar(self, calendar, days):
+        '''Returns the day numbers of the master calendar spanning the quoted days.'''
+        if len(days) == 0:
+            return days
+        if isinstance(calendar, basestring) and calendar == 'exchange':
+            return get_exchange_days(days[0], days[-1])
+        calendar = np.unique(to_days(calendar))
+        for date, keep in ((self.start_date, np.greater_equal), (self.end_date, np.less_equal)):
+            if date is not None:
+                calendar = calendar[keep(calendar, to_days([date])[0])]
+        return calendar
+
+
+    def _get_window(self, clauses=(), params=()):
+        '''Returns the WHERE clause and parameters that limit a query to the date window.'''
+        clauses, params = list(clauses), list(params)
+        for date, operator in ((self.start_date, '>='), (self.end_date, '<=')):
+            if date is None:
+                continue
+            if self._normalized:
+                clauses.append("day %s ?" % operator)
+                params.append(int(to_days([date])[0]))
+            else:
+                clauses.append("Datetime %s ?" % operator)
+                params.append(to_date_strings(to_days([date]))[0])
+        if not clauses:
+            return "", params
+        return " WHERE " + " AND ".join(clauses), params
+
+
+    def _read_quotes(self, clauses=(), params=(), columns=None):
+        '''Returns the rows of the normalized quotes table within the date window as a
+        DataFrame of their symbol_id, day and columns, every quote column by default.'''
+        if columns is None:
+            columns = [column for _, column in quote_db.QUOTE_COLUMNS]
+        where, params = self._get_window(clauses, params)
+        return read_sql_query("SELECT %s FROM quotes" % ", ".join(['symbol_id', 'day'] + columns) + where,
+                              self.con, params=params)
+
+
+    def _get_cells(self, quotes):
+        '''Returns the panel rows and columns of rows of the normalized quotes table, and
+        a mask of those whose date is in the panel and whose symbol is available.'''
+        days = self._days
+        quote_days = quotes['day'].values
+        rows = np.searchsorted(days, quote_days)
+        found = rows < len(days)
+        found[found] = days[rows[found]] == quote_days[found]
+
+        # Map the symbol_id of the database to the symbol id of the panel
+        col_map = np.full(max(self._db_ids.values()) + 1 if self._db_ids else 0, -1, dtype=np.intp)
+        for symbol, db_id in self._db_ids.items():
+            if symbol not in self.UNAVAILABLE_SYMBOLS:
+                col_map[db_id] = self._symbol_ids[symbol]
+        cols = col_map[quotes['symbol_id'].values]
+        found &= cols >= 0
+        return np.where(found, rows, 0), cols, found
+
+
+    def _read_table(self, symbol):
+        '''Returns the quotes of one symbol within the date window, indexed by Datetime.'''
+        if self._normalized:
+            df = self._read_quotes(["symbol_id = ?"], [self._db_ids[symbol]])
+            df = df.rename(columns=dict((column, type) for type, column in quote_db.QUOTE_COLUMNS))
+            df.index = df['day'].values
+            return df.drop(['symbol_id', 'day'], axis=1)
+        where, params = self._get_window()
+        df = read_sql_query("SELECT * from [%s]" % symbol + where, self.con, params=params)
+        df['Datetime'] = df['Datetime'].astype(str)
+        return df.set_index('Datetime')
+
+
+    def _read_dates(self, symbol):
+        '''Returns the dates within the window that have an Adj_Close quote for one table.'''
+        where, params = self._get_window(["Adj_Close IS NOT NULL"])
+        cur = self.con.cursor()
+        return [str(row[0]) for row in cur.execute("SELECT Datetime from [%s]" % symbol + where, params)]
+
+
+    def _store(self, symbol_id, df, slot):
+        '''Scatters a table of quotes into a column of the panel.'''
+        rows = self.get_date_ids(df.index)
+        found = rows >= 0
+        for type in self.QUOTE_TYPES:
+            column = self._panel[type][:, slot]
+            column[:] = np.nan
+            if self._symbols[symbol_id] not in self.UNAVAILABLE_SYMBOLS:
+                column[rows[found]] = df[type].values[found]
+        self._slots[symbol_id] = slot
+        if not self._has_available[symbol_id]:
+            self._available[:, symbol_id] = ~np.isnan(self._panel['Adj_Close'][:, slot])
+            self._has_available[symbol_id] = True
+
+
+    def _load_availability(self, symbol_ids):
+        '''Reads the dates of the tables of symbols whose availability isn't known yet.'''
+        for symbol_id in np.unique(symbol_ids[~self._has_available[symbol_ids]]):
+            symbol = self._symbols[symbol_id]
+            if symbol not in self.UNAVAILABLE_SYMBOLS:
+                rows = self.get_date_ids(self._read_dates(symbol))
+                self._available[rows[rows >= 0], symbol_id] = True
+            self._has_available[symbol_id] = True
+
+
+    def _fill(self, slots):
+        '''Fills the dates without a bar in the panel columns slots by the fill policy.'''
+        if self.fill is None:
+            return
+
+        # Find the last bar on or before every date, as a date id of the same column
+        bars = ~np.isnan(self._panel['Adj_Close'][:, slots])
+        rows = np.arange(bars.shape[0])[:, np.newaxis]
+        last = np.maximum.accumulate(np.where(bars, rows, -1), axis=0)
+        fill = ~bars & (last >= 0)
+        if self.fill_limit is not None:
+            fill &= rows - last <= self.fill_limit
+        source_rows, source_cols = last[fill], np.nonzero(fill)[1]
+
+        # Filled dates only read bars, so the order quote types are filled in doesn't matter
+        for type in self.QUOTE_TYPES:
+            column = self._panel[type][:, slots]
+            if type == 'Volume' and self.fill == 'asof':
+                column[fill] = 0
+            else:
+                source = 'Close' if self.fill == 'asof' and type != 'Adj_Close' else type
+                column[fill] = self._panel[source][:, slots][source_rows, source_cols]
+            self._panel[type][:, slots] = column
+
+
+    def _get_slot(self, symbol_id):
+        '''Returns the panel column of a symbol, loading it first when lazy.'''
+        if not self.lazy:
+            return symbol_id
+
+        # Mark the symbol as most recently used if it is already loaded
+        slot = self._lru.pop(symbol_id, None)
+        if slot is None:
+            # Take a free column or evict the least recently used symbol
+            if len(self._lru) < self._panel['Adj_Close'].shape[1]:
+                slot = len(self._lru)
+            else:
+                evicted, slot = self._lru.popitem(last=False)
+                self._slots[evicted] = -1
+            self._store(symbol_id, self._read_table(self._symbols[symbol_id]), slot)
+            self._fill([slot])
+        self._lru[symbol_id] = slot
+        return slot
+
+
+    def _grow(self, capacity):
+        '''Widens the pool of panel columns of a lazy panel to capacity symbols.'''
+        shape = (len(self._dates), capacity - self._panel['Adj_Close'].shape[1])
+        for type in self.QUOTE_TYPES:
+            self._panel[type] = np.hstack([self._panel[type], np.full(shape, np.nan, dtype=self.dtype)])
+        print("QuoteManager grew its panel past max_memory_mb to hold %s symbols at once..." % capacity)
+
+
+    def _get_slots(self, symbols):
+        '''Returns an array of panel columns for the passed symbols.'''
+        symbol_ids = self.get_symbol_ids(symbols)
+        if not self.lazy:
+            return symbol_ids
+
+        # Every symbol must stay loaded until the lookup reads it, so none may evict another
+        count = len(np.unique(symbol_ids))
+        if count > self._panel['Adj_Close'].shape[1]:
+            self._grow(count)
+        return np.array([self._get_slot(symbol_id) for symbol_id in symbol_ids], dtype=np.intp)
+
+
+    def get_symbols(self):
+        '''Returns the list of symbols in the panel ordered by symbol id.'''
+        return list(self._symbols)
+
+
+    def get_dates(self):
+        '''Returns the sorted list of 'YYYY_MM_DD' dates in the panel ordered by date id.'''
+        return list(self._dates)
+
+
+    def get_days(self):
+        '''Returns the sorted int32 array of day numbers in the panel ordered by date id.'''
+        return self._days.copy()
+
+
+    def get_symbol_ids(self, symbols):
+        '''Returns an array of integer ids for the passed symbols, which may already be ids.'''
+        if isinstance(symbols, np.ndarray) and symbols.dtype.kind in 'iu':
+            return symbols.astype(np.intp)
+        return np.array([self._symbol_ids[symbol] for symbol in symbols], dtype=np.intp)
+
+
+    def get_date_ids(self, dates, asof=False):
+        '''Returns an array of integer ids for the passed dates, -1 where a date is not in
+        the panel.  With asof=True each date takes the id of the last panel date on or
+        before it, -1 where it is before the first.'''
+        days = to_days(dates)
+        if asof:
+            return (np.searchsorted(self._days, days, side='right') - 1).astype(np.intp)
+        rows = np.searchsorted(self._days, days)
+        found = rows < len(self._days)
+        found[found] = self._days[rows[found]] == days[found]
+        return np.where(found, rows, -1).astype(np.intp)
+
+
+    def _get_date_id(self, date):
+        '''Returns the integer id of one date, -1 where it is not in the panel.'''
+        row = self._date_ids.get(date)
+        if row is None and not isinstance(date, numbers.Integral):
+            row = self._date_ids.get(int(to_days([date])[0]))
+        return -1 if row is None else row
+
+
+    def _load_last_bars(self, symbol_ids):
+        '''Computes once per symbol the date id of its last Adj_Close bar on or before
+        every date id, -1 where there is none.'''
+        missing = np.unique(symbol_ids[~self._has_last_bars[symbol_ids]])
+        if len(missing) == 0:
+            return
+        if self._last_bars is None:
+            self._last_bars = np.empty((len(self._dates), len(self._symbols)), dtype=np.int32)
+        self._load_availability(missing)
+        available = np.asarray(self._available[:, missing], dtype=bool)
+        rows = np.arange(len(self._dates), dtype=np.int32)[:, np.newaxis]
+        self._last_bars[:, missing] = np.maximum.accumulate(np.where(available, rows, -1), axis=0)
+        self._has_last_bars[missing] = True
+
+
+    def _get_bar_ids(self, rows, symbol_ids):
+        '''Returns a (rows x symbols) array of the date id of the last Adj_Close bar of
+        each symbol on or before each date id of rows, -1 where there is none.'''
+        if not len(rows) or rows.max() < 0:
+            return np.full((len(rows), len(symbol_ids)), -1, dtype=np.intp)
+        self._load_last_bars(symbol_ids)
+        last = self._last_bars[np.ix_(np.maximum(rows, 0), symbol_ids)].astype(np.intp)
+        return np.where((rows >= 0)[:, np.newaxis], last, -1)
+
+
+    def get_quote(self, symbol, date, type='Adj_Close', asof=False):
+        '''Returns the quote of a symbol or symbol id on a date, NaN where unavailable.
+        With asof=True it is the quote of the symbol's last bar on or before the date.'''
         assert type in self.QUOTE_TYPES, \
             "ERROR in QuoteManager.get_quote() >> %s is not in %s" % (type, self.QUOTE_TYPES)
 
-        # If there is not quote data for a given symbol return nan
-        if symbol == 'ANVGQ':
-            print("Quote data is not available for %s" % symbol)
-            return 'nan'
-
-        # If there is quote data available for the given date, return it
-        if date in self._quotes[symbol][type].index:
-            return self._quotes[symbol][type][date]
+        # Symbols with bad quote data are never loaded, so their panel columns are NaN
+        if isinstance(symbol, numbers.Integral):
+            symbol_id = symbol
+        elif symbol in self.UNAVAILABLE_SYMBOLS:
+            return np.nan
         else:
-            print("Quote data is not available on %s for %s" % (date, symbol))
-            return 'nan'
+            symbol_id = self._symbol_ids[symbol]
+        if asof:
+            return self.get_quote_matrix(np.array([symbol_id]), [date], type, asof=True)[0, 0]
+        row = self._get_date_id(date)
+        if row < 0:
+            return np.nan
+        return self._panel[type][row, self._get_slot(symbol_id)]
+
+
+    def get_quotes(self, symbols, date, type='Adj_Close', asof=False):
+        '''Returns an array of quotes for the passed symbols on a date, NaN where unavailable.
+        With asof=True each is the quote of the symbol's last bar on or before the date.'''
+        assert type in self.QUOTE_TYPES, \
+            "ERROR in QuoteManager.get_quotes() >> %s is not in %s" % (type, self.QUOTE_TYPES)
+
+        if asof:
+            return self.get_quote_matrix(symbols, [date], type, asof=True)[0]
+        cols = self._get_slots(symbols)
+        row = self._get_date_id(date)
+        if row < 0:
+            return np.full(len(cols), np.nan, dtype=self.dtype)
+        return np.asarray(self._panel[type][row, cols])
+
+
+    def get_quote_matrix(self, symbols, dates, type='Adj_Close', asof=False):
+        '''Returns a (dates x symbols) array of quotes, NaN where unavailable.  With
+        asof=True each is the quote of the symbol's last bar on or before the date.'''
+        assert type in self.QUOTE_TYPES, \
+            "ERROR in QuoteManager.get_quote_matrix() >> %s is not in %s" % (type, self.QUOTE_TYPES)
+
+        cols = self._get_slots(symbols)
+        rows = self.get_date_ids(dates, asof)
+        if asof:
+            # Search each symbol's own bars rather than taking the quote of the panel date
+            rows = self._get_bar_ids(rows, self.get_symbol_ids(symbols))
+            matrix = np.asarray(self._panel[type][np.maximum(rows, 0), cols])
+            return np.where(rows >= 0, matrix, np.nan).astype(self.dtype, copy=False)
+        matrix = np.asarray(self._panel[type][np.ix_(rows, cols)])
+        return np.where((rows >= 0)[:, np.newaxis], matrix, np.nan).astype(self.dtype, copy=False)
+
+
+    def get_availability(self, symbols, dates):
+        '''Returns a boolean (dates x symbols) array, True where an Adj_Close quote is
+        available.  It reads the mask built at load time, so a lazy panel only reads the
+        dates of tables it hasn't used before.'''
+        rows = self.get_date_ids(dates)
+        symbol_ids = self.get_symbol_ids(symbols)
+        self._load_availability(symbol_ids)
+        available = np.array(self._available[np.ix_(rows, symbol_ids)], dtype=bool)
+        available[rows < 0] = False
+        return available
 
 
 # Used for debugging and development
 if __name__ == '__main__':
     qm = QuoteManager('data/daily_gold.db')
-    for symbol in qm._quotes:
+    for symbol in qm.get_symbols():
         print(qm.get_quote(symbol, '2016_10_17'))
         pass
+    print(qm.get_quotes(qm.get_symbols(), '2016_10_17'))
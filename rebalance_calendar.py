@@ -0,0 +1,167 @@
+import datetime
+import numpy as np
+
+
+# Frequencies a rebalance schedule can be built on, besides a custom list of dates
+FREQUENCIES = ['day', 'week', 'month', 'quarter', 'year']
+
+
+# Convert 'YYYY-MM-DD' or 'YYYY_MM_DD' dates, optionally with a time, or day numbers to datetime64
+def to_datetime64(dates):
+    dates = np.asarray(dates)
+    if np.issubdtype(dates.dtype, np.datetime64):
+        return dates
+    if dates.dtype.kind in 'iu':
+        return dates.astype(np.int64).astype('datetime64[D]')
+    dates = np.char.replace(dates.astype(str), '_', '-')
+    return dates.astype('datetime64')
+
+
+# Dates are encoded throughout the engine as int32 numbers of days since 1970-01-01,
+#   converted once where they are read from or written to the database, CSV files and output
+def to_days(dates):
+    '''Returns an int32 array of the day numbers of dates given as strings, datetime64,
+    date or datetime objects, or day numbers.'''
+    dates = np.asarray(dates)
+    if dates.size == 0:
+        return np.zeros(dates.shape, dtype=np.int32)
+    if dates.dtype.kind in 'iu':
+        return dates.astype(np.int32)
+    if dates.dtype.kind == 'O' and isinstance(dates.flat[0], datetime.date):
+        dates = dates.astype('datetime64[D]')
+    return to_datetime64(dates).astype('datetime64[D]').astype(np.int32)
+
+
+# Convert day numbers to the 'YYYY_MM_DD' strings used in files and output
+def to_date_strings(days):
+    days = np.asarray(days, dtype=np.int64).astype('datetime64[D]')
+    return np.char.replace(np.datetime_as_string(days).astype(str), '-', '_').tolist()
+
+
+# Days the NYSE closed outside its regular holidays
+EXCHANGE_CLOSINGS = ['1985-09-27', '1994-04-27', '2001-09-11', '2001-09-12', '2001-09-13', '2001-09-14',
+                     '2004-06-11', '2007-01-02', '2012-10-29', '2012-10-30', '2018-12-05', '2025-01-09']
+
+
+# Find the n-th weekday of a month, counting back from the next month when n is negative
+def _nth_weekday(years, month, weekday, n):
+    months = (years - 1970) * 12 + month - 1
+    if n < 0:
+        months += 1
+    starts = months.astype('datetime64[M]').astype('datetime64[D]')
+    return np.busday_offset(starts, n if n < 0 else n - 1, roll='forward', weekmask=weekday)
+
+
+# Move a fixed date holiday on a weekend to the Friday before or the Monday after
+def _observed(days, saturday=True):
+    weekday = (days.astype(np.int64) + 3) % 7
+    days = np.where(weekday == 6, days + 1, days)
+    if not saturday:
+        return days[weekday != 5]
+    return np.where(weekday == 5, days - 1, days)
+
+
+def get_exchange_holidays(start_year, end_year):
+    '''Returns a sorted datetime64[D] array of the NYSE holidays from start_year through
+    end_year, using the holidays observed since 1998 and EXCHANGE_CLOSINGS.'''
+    years = np.arange(start_year, end_year + 1)
+    def fixed(month, day):
+        return ((years - 1970) * 12 + month - 1).astype('datetime64[M]').astype('datetime64[D]') + day - 1
+
+    # Easter Sunday by the anonymous Gregorian algorithm, less two days for Good Friday
+    a, b, c = years % 19, years // 100, years % 100
+    h = (19 * a + b - b // 4 - (b - (b + 8) // 25 + 1) // 3 + 15) % 30
+    l = (32 + 2 * (b % 4) + 2 * (c // 4) - h - c % 4) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    easter_month = (h + l - 7 * m + 114) // 31
+    easter_day = (h + l - 7 * m + 114) % 31 + 1
+    good_friday = ((years - 1970) * 12 + easter_month - 1).astype('datetime64[M]').astype('datetime64[D]') + \
+                  easter_day - 3
+
+    # New Year's Day falling on a Saturday is not made up on the Friday before
+    holidays = [_observed(fixed(1, 1), saturday=False),
+                _nth_weekday(years, 1, 'Mon', 3)[years >= 1998],
+                _nth_weekday(years, 2, 'Mon', 3),
+                good_friday,
+                _nth_weekday(years, 5, 'Mon', -1),
+                _observed(fixed(6, 19))[years >= 2022],
+                _observed(fixed(7, 4)),
+                _nth_weekday(years, 9, 'Mon', 1),
+                _nth_weekday(years, 11, 'Thu', 4),
+                _observed(fixed(12, 25)),
+                np.array(EXCHANGE_CLOSINGS, dtype='datetime64[D]')]
+    holidays = np.unique(np.concatenate(holidays))
+    return holidays[(holidays >= fixed(1, 1)[0]) & (holidays <= fixed(12, 31)[-1])]
+
+
+# Build the exchange calendar once so quotes can be checked against it with array operations
+def get_exchange_days(start, end):
+    '''Returns an int32 array of the day numbers the NYSE is open from start through end.'''
+    start, end = to_datetime64([start, end]).astype('datetime64[D]')
+    holidays = get_exchange_holidays(start.astype(object).year, end.astype(object).year)
+    days = np.arange(start, end + 1, dtype='datetime64[D]')
+    return days[np.is_busday(days, holidays=holidays)].astype(np.int32)
+
+
+# Label every date with the period it falls in, as an integer that grows with time
+def get_period_ids(dates, frequency='month'):
+    '''Returns an int64 array holding the period of each date for the passed frequency.'''
+    assert frequency in FREQUENCIES, \
+        "ERROR in get_period_ids() >> %s is not in %s" % (frequency, FREQUENCIES)
+    days = to_datetime64(dates).astype('datetime64[D]')
+    if frequency == 'day':
+        return days.astype(np.int64)
+    if frequency == 'week':
+        # Day 0 is Thursday 1970-01-01, so shifting by 3 starts each week on a Monday
+        return (days.astype(np.int64) + 3) // 7
+    months = days.astype('datetime64[M]').astype(np.int64)
+    if frequency == 'quarter':
+        return months // 3
+    if frequency == 'year':
+        return months // 12
+    return months
+
+
+# Find the rebalance days of a sorted date index in one pass
+def get_rebalance_positions(dates, frequency='month', period=1, start=None, end=None):
+    '''Returns an array of integer positions into dates for the last date of every
+    period-th period, counting from the first date on or after start.  The last date
+    up to end is always included so a partial final period still closes.
+
+    frequency is one of FREQUENCIES, or a list of custom dates which are each moved
+    to the last date in the index on or before them.'''
+    assert period >= 1, "ERROR in get_rebalance_positions() >> period must be at least 1, not %s" % period
+    stamps = to_datetime64(dates)
+    first = 0 if start is None else np.searchsorted(stamps, to_datetime64([start])[0], side='left')
+    last = len(stamps) if end is None else np.searchsorted(stamps, to_datetime64([end])[0], side='right')
+    if first >= last:
+        return np.zeros(0, dtype=np.intp)
+
+    if isinstance(frequency, basestring):
+        # A date ends its period when the next date falls in a later one
+        period_ids = get_period_ids(stamps[first:last], frequency)
+        ends = np.flatnonzero(period_ids[1:] != period_ids[:-1])
+        positions = np.append(ends, last - first - 1)[period-1::period] + first
+    else:
+        custom = np.searchsorted(stamps[first:last], np.sort(to_datetime64(frequency)), side='right') - 1
+        positions = np.unique(custom[custom >= 0]) + first
+
+    if len(positions) == 0 or positions[-1] != last - 1:
+        positions = np.append(positions, last - 1)
+    return positions.astype(np.intp)
+
+
+# Find the rebalance days of a date list, returned as the same strings
+def get_rebalance_days(dates, frequency='month', period=1, start=None, end=None):
+    '''Returns the list of dates at get_rebalance_positions().'''
+    dates = list(dates)
+    return [dates[i] for i in get_rebalance_positions(dates, frequency, period, start, end)]
+
+
+# Used for debugging and development
+if __name__ == '__main__':
+    days = ['2016_01_04', '2016_01_29', '2016_02_01', '2016_02_29', '2016_03_01', '2016_03_31', '2016_04_01']
+    print(get_rebalance_days(days))
+    print(get_rebalance_days(days, period=2))
+    print(get_rebalance_days(days, 'week', start='2016_02_01'))
+    print(get_rebalance_days(days, ['2016_02_15', '2016_03_31']))
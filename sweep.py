@@ -0,0 +1,106 @@
+import itertools
+import multiprocessing
+import time
+import numpy as np
+import pandas as pd
+import analytics
+from backtest import DEFAULT_CONFIG, Backtest, load_signals
+from gold_backtester import GDX_CSV_PATH, OUTPUT_PATH, SIGNALS_PATH, load_quotes
+
+# Parameters
+PROCESSES       = None                      # Number of worker processes, None for one per CPU
+SWEEP_GRID      = {                         # Values to try for each parameter of backtest.DEFAULT_CONFIG
+    'rebal_period'  : [1, 2, 3],
+    'long_count'    : [5, 10],
+    'short_count'   : [5, 10],
+    }
+
+
+# Data shared by every run in a worker process, set once per worker by _init_worker()
+_sweep_data = None
+
+
+def expand_grid(grid):
+    '''Returns a list of configs, one for every combination of the values in grid.'''
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+STATS = ['final_value', 'total_return', 'cagr', 'volatility', 'sharpe', 'sortino', 'max_drawdown',
+         'long_return', 'short_return', 'turnover', 'trades']
+
+
+def summarize(runs):
+    '''Adds the performance statistics of each run to its result dict.  runs is a list
+    of (result, dates, portfolio values, traded values) tuples, and runs sharing the
+    same rebalance dates are stacked and summarized together.'''
+    groups = {}
+    for run in runs:
+        groups.setdefault(tuple(run[1]), []).append(run)
+    for dates, group in groups.items():
+        stats = analytics.summarize(np.vstack([run[2] for run in group]), dates,
+                                    traded_values=np.vstack([run[3] for run in group]))
+        for i, run in enumerate(group):
+            run[0].update((name, values[i]) for name, values in stats.items())
+    return [run[0] for run in runs]
+
+
+def _init_worker(quote_manager, signals, gdx_symbols):
+    # With fork these arguments are inherited rather than pickled, so workers
+    #   share the parent's quote panel copy-on-write
+    global _sweep_data
+    _sweep_data = (quote_manager, signals, gdx_symbols)
+
+
+def _run_config(args):
+    run, config = args
+    start = time.time()
+    history, orders = Backtest(config, *_sweep_data).run(verbose=False)
+    result = dict(config, run=run, wall_time=time.time() - start,
+                  final_value   = history.loc['Portfolio_Value'].iloc[-1],
+                  long_return   = history.loc['Long_Return'].sum(),
+                  short_return  = history.loc['Short_Return'].sum(),
+                  trades        = len(orders))
+    dates = list(history.columns)
+    return (result, dates, history.loc['Portfolio_Value'].values,
+            analytics.get_traded_values(dates, orders.date, orders.shares, orders.price))
+
+
+def run_sweep(configs, quote_manager, signals, gdx_symbols, processes=PROCESSES):
+    '''Runs a backtest for each config across a pool of processes and returns a
+    summary DataFrame with one row per config, in the order the configs were passed.
+    Each config only needs the keys that differ from DEFAULT_CONFIG.'''
+    assert not quote_manager.lazy, \
+        "ERROR in run_sweep() >> a lazy QuoteManager can't be shared between processes"
+
+    jobs = list(enumerate(configs))
+    if processes == 1:
+        _init_worker(quote_manager, signals, gdx_symbols)
+        runs = [_run_config(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (quote_manager, signals, gdx_symbols))
+        try:
+            runs = pool.map(_run_config, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    columns = ['run'] + sorted(set(DEFAULT_CONFIG) & set().union(*[config.keys() for config in configs])) + \
+              STATS + ['wall_time']
+    return pd.DataFrame(summarize(runs), columns=columns).set_index('run')
+
+
+if __name__ == '__main__':
+
+    # Load the data once in the parent process before the workers are forked
+    configs = expand_grid(SWEEP_GRID)
+    signals, gdx_symbols = load_signals(SIGNALS_PATH, GDX_CSV_PATH)
+    quote_manager = load_quotes(signals, start_day=min(dict(DEFAULT_CONFIG, **config)['start_day']
+                                                       for config in configs))
+
+    summary = run_sweep(configs, quote_manager, signals, gdx_symbols)
+    print(summary.to_string())
+
+    import datetime
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    summary.to_csv(OUTPUT_PATH + 'sweep_{}.csv'.format(timestamp))
@@ -0,0 +1,131 @@
+import os
+import shutil
+import sqlite3 as lite
+import tempfile
+import unittest
+import numpy as np
+import quote_db
+from backtest import Backtest, load_signals
+from history_writer import HistoryWriter, read_table
+from quote_manager import QuoteManager
+from rebalance_calendar import to_days
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A short run keeps the tests fast while spanning enough rebalances to resume from
+CONFIG = {'start_day': '2013_01_02'}
+LAST_DAY = '2014_12_31'
+
+
+# Write a normalized quote database of random walks for symbols on every weekday between two dates
+def make_quote_db(db_path, symbols, start, end, seed=1):
+    random = np.random.RandomState(seed)
+    days = np.arange(to_days([start])[0], to_days([end])[0] + 1)
+    days = days[np.is_busday(days.astype('datetime64[D]'))]
+    con = lite.connect(db_path)
+    quote_db.create_schema(con)
+    for symbol in symbols:
+        symbol_id = quote_db.get_symbol_id(con, symbol)
+        prices = random.uniform(5., 80.) * np.cumprod(1 + random.normal(.0003, .02, len(days)))
+        volumes = random.randint(1000, 100000, len(days))
+        con.executemany("INSERT INTO quotes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(symbol_id, int(day), price, price * 1.01, price * .99, price, int(volume), price)
+                         for day, price, volume in zip(days, prices, volumes)])
+    con.commit()
+    con.close()
+
+
+class ResumeTest(unittest.TestCase):
+
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        signals, cls.gdx_symbols = load_signals(os.path.join(SOURCE_DIR, 'signals/signal_data.csv'),
+                                                os.path.join(SOURCE_DIR, 'symbols/gold_gdx.csv'))
+        cls.signals = signals[signals.index <= to_days([LAST_DAY])[0]]
+        cls.db_path = os.path.join(cls.path, 'quotes.db')
+        make_quote_db(cls.db_path, sorted(set(cls.signals.columns) | set(cls.gdx_symbols)), '2012_12_03', LAST_DAY)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+
+    def setUp(self):
+        self.checkpoint_path = os.path.join(self.path, 'checkpoints')
+        if os.path.exists(self.checkpoint_path):
+            shutil.rmtree(self.checkpoint_path)
+
+
+    def get_backtest(self, last_day=LAST_DAY):
+        signals = self.signals[self.signals.index <= to_days([last_day])[0]]
+        quote_manager = QuoteManager(self.db_path, start_date=CONFIG['start_day'], end_date=signals.index[-1])
+        return Backtest(CONFIG, quote_manager, signals, self.gdx_symbols)
+
+
+    def run_to_files(self, name, last_day=LAST_DAY, checkpoint_path=None):
+        '''Runs with keep=False and returns the positions and trades written to disk.'''
+        backtest = self.get_backtest(last_day)
+        writer = HistoryWriter(os.path.join(self.path, name + '_'))
+        try:
+            backtest.run(verbose=False, writer=writer, keep=False, checkpoint_path=checkpoint_path)
+        finally:
+            writer.close()
+        return [read_table(writer.path_prefix, table) for table in ('positions', 'trades')]
+
+
+    def test_resume_after_mid_period_cut(self):
+        self.get_backtest('2014_07_22').run(verbose=False, checkpoint_path=self.checkpoint_path)
+
+        # The partial period ending on the cut is rerun from the close of the month before it
+        backtest = self.get_backtest()
+        cursor, state = backtest.get_checkpoint_store(self.checkpoint_path).load_latest()
+        june = self.signals.index[self.signals.index < to_days(['2014_07_01'])[0]][-1]
+        self.assertEqual(backtest.rebalance_days[cursor], june)
+
+        history, orders = backtest.run(verbose=False, checkpoint_path=self.checkpoint_path)
+        full_backtest = self.get_backtest()
+        full_history, full_orders = full_backtest.run(verbose=False)
+        self.assertTrue(history.equals(full_history))
+        self.assertTrue(orders.equals(full_orders))
+        self.assertTrue(backtest.positions.equals(full_backtest.positions))
+
+
+    def test_resume_without_keep(self):
+        self.run_to_files('cut', '2014_07_22', self.checkpoint_path)
+
+        # The rows before the checkpoint come back from the files of the run that saved it
+        positions, trades = self.run_to_files('resumed', checkpoint_path=self.checkpoint_path)
+        full_positions, full_trades = self.run_to_files('full')
+        self.assertTrue(positions.equals(full_positions))
+        self.assertTrue(trades.equals(full_trades))
+        self.assertGreater(len(trades[trades.date < '2014_07_01']), 0)
+
+
+class LazyQuoteTest(unittest.TestCase):
+
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.path, 'quotes.db')
+        self.symbols = ['AAA', 'BBB', 'CCC', 'DDD', 'SPY']
+        make_quote_db(self.db_path, self.symbols, '2014_01_02', '2014_12_31')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+    def test_lookup_past_memory_budget(self):
+        # A budget smaller than one symbol's quotes still answers a lookup of every symbol
+        quote_manager = QuoteManager(self.db_path, lazy=True, max_memory_mb=.001)
+        expected = QuoteManager(self.db_path).get_quote_matrix(self.symbols, ['2014_03_03', '2014_09_30'])
+        matrix = quote_manager.get_quote_matrix(self.symbols, ['2014_03_03', '2014_09_30'])
+        self.assertTrue(np.array_equal(matrix, expected))
+        self.assertEqual(quote_manager.get_quote('CCC', '2014_09_30'), expected[1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()